@@ -2,8 +2,10 @@
 import renpy
 
 import utils
-from controller import RenderController, RenderContext, ControllerContextStore
-from rendering import Renderer2D, Renderer3D, SkinnedRenderer
+from controller import RenderController, RenderContext, ControllerContextStore, EventQueue, makeTag, makeTagDescription
+from scheduler import RedrawScheduler
+from tasks import PreparedStore
+from rendering import Renderer2D, Renderer3D, SkinnedRenderer, RigTemplateCache, SurfaceCache
 from rigeditor import RigEditor
 from skinnedplayer import TrackInfo, AnimationPlayer
 from shadercode import *
@@ -23,9 +25,27 @@ MODE_SKINNED = "skinned"
 
 ZERO_INFLUENCE = "zeroinfluence.png"
 
+READBACK_SYNC = "sync" #Lowest latency, waits for the GPU every frame
+READBACK_ASYNC = "async" #Highest throughput, the image lags one frame behind
+
+RATE_FULL = "full" #Redraw at config.fps
+RATE_AMBIENT = "ambient" #Redraw at config.ambientFps, for slow effects
+RATE_IDLE = "idle" #Redraw only on new input or interaction
+
+OUTPUT_SURFACE = "surface" #Read the image back into a surface that Ren'Py uploads again
+OUTPUT_TEXTURE = "texture" #Copy the image into a Ren'Py texture on the GPU, falls back to a surface
+
 class config:
     enabled = True
     fps = 60
+    ambientFps = 15
+    loadThreads = 0 #Threads for decoding and cropping rig images, 0 uses one per core
+    lazyMeshes = True #Decode bone meshes of rig files only when they are first drawn or edited
+    surfaceCacheSize = 64 * 1024 * 1024 #Bytes of decoded rig images kept in memory
+    frameBudget = 0.008 #Seconds all displayables can spend rendering per frame before the least important ones are slowed down
+    idleRedrawDelay = 0.25 #Longest redraw interval for displayables whose image is not changing
+    readback = READBACK_SYNC
+    output = OUTPUT_SURFACE
     flipMeshX = True
 
 def log(message):
@@ -54,6 +74,10 @@ def isSupported(verbose=False):
     return True
 
 _controllerContextStore = ControllerContextStore()
+_redrawScheduler = RedrawScheduler()
+_preparedRenderers = PreparedStore()
+_rigTemplates = RigTemplateCache()
+_surfaceCache = SurfaceCache()
 
 _coreSetMode = None
 _coreSetModeCounter = 0
@@ -0,0 +1,112 @@
+
+#Measurements for development. Run from the Ren'Py console, for example:
+#
+#   import shader.benchmark
+#   shader.benchmark.measureRigMemory("rig/doll.rig")
+
+import sys
+import types
+import ctypes
+
+import renpy
+
+import shader
+import skin
+import skinnedmesh
+import skinnedanimation
+import rendering
+import jsonwriter
+
+SKIPPED_TYPES = (type, types.ModuleType, types.FunctionType, types.MethodType)
+if sys.version_info[0] < 3:
+    SKIPPED_TYPES += (types.ClassType,)
+
+def getDeepSize(obj, seen=None):
+    #Bytes used by an object and everything it references that was not counted yet
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, SKIPPED_TYPES):
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, ctypes.Array):
+        size += ctypes.sizeof(obj)
+    elif isinstance(obj, dict):
+        for key, value in obj.items():
+            size += getDeepSize(key, seen) + getDeepSize(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for value in obj:
+            size += getDeepSize(value, seen)
+    else:
+        if hasattr(obj, "__dict__"):
+            size += getDeepSize(obj.__dict__, seen)
+        for name in jsonwriter.getSlots(type(obj)):
+            size += getDeepSize(getattr(obj, name, None), seen)
+    return size
+
+def getInstanceSize(obj):
+    #Bytes used by the object itself, without what its attributes point to
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__"):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+def findAnimations(rigPath):
+    base = rigPath.rsplit(".", 1)[0] + " "
+    return [f for f in renpy.exports.list_files() if f.startswith(base) and f.endswith(".anim")]
+
+def computeWeights(bones, transforms):
+    #The same bone influences that are created when vertex weights are computed
+    mapping = {}
+    for i, trans in enumerate(transforms):
+        trans.index = i
+        mapping[trans.bone.name] = trans
+
+    results = []
+    for trans in transforms:
+        mesh = trans.bone.mesh
+        if mesh:
+            blockers = skinnedmesh.findBlockerNames(trans.bone, bones)
+            for i in range(mesh.getVertexCount()):
+                results.append(skinnedmesh.findBoneInfluences(mesh.getVertex(i), mapping, blockers))
+    return results
+
+def measureRigMemory(rigPath, animations=None):
+    #Memory used by the bones of a rig, its animations, one set of bone
+    #transforms and the bone influences of a weight update.
+    if animations is None:
+        animations = findAnimations(rigPath)
+
+    bones, data = skin.loadFromFile(rigPath)
+    renderer = rendering.SkinnedRenderer()
+    renderer.bones = bones
+    renderer.root = [bone for bone in bones.values() if not bone.parent][0]
+    transforms = renderer.computeBoneTransforms()
+    weights = computeWeights(bones, transforms)
+    frames = [skinnedanimation.loadAnimationFromFile(path) for path in animations]
+
+    seen = set()
+    results = {
+        "bones": getDeepSize(bones, seen),
+        "animations": getDeepSize(frames, seen),
+        "transforms": getDeepSize(transforms, seen),
+        "weights": getDeepSize(weights, seen),
+    }
+
+    instances = {
+        "SkinningBone": bones.values()[0],
+        "BoneTransform": transforms[0],
+        "BoneWeight": skinnedmesh.BoneWeight(0.0, 0, transforms[0]),
+        "KeyFrame": skinnedanimation.KeyFrame(),
+        "Frame": skinnedanimation.Frame(),
+        "BoneData": skinnedanimation.BoneData(),
+    }
+    results["instances"] = dict((name, getInstanceSize(obj)) for name, obj in instances.items())
+
+    shader.log("Memory of '%s' with %i animations:" % (rigPath, len(animations)))
+    for key in ("bones", "animations", "transforms", "weights"):
+        shader.log("    %s: %i bytes" % (key, results[key]))
+    for name, size in sorted(results["instances"].items()):
+        shader.log("    %s instance: %i bytes" % (name, size))
+    return results
@@ -1,11 +1,16 @@
 
 import renpy
+import pygame_sdl2 as pygame
+import ctypes
+import hashlib
+import collections
 from OpenGL import GL as gl
 
 import shader
+import glstate
 
 class RenderContext(object):
-    def __init__(self, renderer, w, h, time, shownTime, animationTime, uniforms, mousePos, events, store, overlayRender):
+    def __init__(self, renderer, w, h, time, shownTime, animationTime, uniforms, mousePos, events, store):
         self.renderer = renderer
         self.width = w
         self.height = h
@@ -17,23 +22,106 @@ class RenderContext(object):
         self.events = events
         self.store = store
         self.continueRendering = True
-        self.overlayRender = overlayRender
+        self.overlayRender = None
         self.overlayCanvas = None
 
     def createOverlayCanvas(self):
         if self.overlayCanvas is not None:
             return
+        #Created only on demand, most frames don't draw any overlay
+        self.overlayRender = renpy.Render(self.width, self.height)
         self.overlayCanvas = self.overlayRender.canvas()
         self.overlayCanvas.rect("#f00", (0, 0, self.width - 1, self.height - 1), 1)
 
 
+class EventQueue:
+    #Bounded queue of (event, pos) pairs waiting for the next frame. Consecutive
+    #mouse motion is merged into a single event whose rel is the sum of the merged
+    #ones, because only the latest position matters between two frames.
+
+    def __init__(self, size=100):
+        self.events = collections.deque(maxlen=size)
+        self.lastPos = None
+        self.motion = [0.0, 0.0]
+        self.lastTake = None
+
+    def add(self, event, pos):
+        if event.type == pygame.MOUSEMOTION:
+            if self.lastPos:
+                self.motion[0] += pos[0] - self.lastPos[0]
+                self.motion[1] += pos[1] - self.lastPos[1]
+            self.lastPos = pos
+
+            if self.events:
+                last, lastPos = self.events[-1]
+                if last.type == pygame.MOUSEMOTION and getattr(last, "buttons", None) == getattr(event, "buttons", None):
+                    lastRel = getattr(last, "rel", (0, 0))
+                    rel = getattr(event, "rel", (0, 0))
+                    merged = pygame.event.Event(pygame.MOUSEMOTION, pos=getattr(event, "pos", pos),
+                        rel=(lastRel[0] + rel[0], lastRel[1] + rel[1]), buttons=getattr(event, "buttons", (0, 0, 0)))
+                    self.events[-1] = (merged, pos)
+                    return
+
+        self.events.append((event, pos))
+
+    def take(self):
+        events = list(self.events)
+        self.events.clear()
+        return events
+
+    def takeVelocity(self, width, height, now):
+        #Mouse movement since the previous call in texture units per second
+        velocity = (0.0, 0.0)
+        if self.lastTake is not None and now > self.lastTake and width and height:
+            elapsed = now - self.lastTake
+            velocity = (self.motion[0] / float(width) / elapsed, self.motion[1] / float(height) / elapsed)
+        self.motion = [0.0, 0.0]
+        self.lastTake = now
+        return velocity
+
+
+#Digests of shader sources. The sources are usually shared module level strings,
+#so each one is hashed only once. Cleared if too many unique sources are seen.
+_sourceDigests = {}
+MAX_SOURCE_DIGESTS = 256
+
+def getDigest(text):
+    if isinstance(text, unicode):
+        text = text.encode("utf-8")
+    return hashlib.sha1(text).hexdigest()
+
+def getSourceDigest(source):
+    digest = _sourceDigests.get(source)
+    if digest is None:
+        if len(_sourceDigests) >= MAX_SOURCE_DIGESTS:
+            _sourceDigests.clear()
+        digest = getDigest(source)
+        _sourceDigests[source] = digest
+    return digest
+
+def makeTag(mode, image, vertexShader, pixelShader, textures, uniforms, args):
+    #Fixed size key for a displayable, the shader sources are represented by their digests
+    key = "/".join([mode, image, getSourceDigest(vertexShader), getSourceDigest(pixelShader),
+        str(textures), str(uniforms), str(args)])
+    return getDigest(key)
+
+def makeTagDescription(mode, image, vertexShader, pixelShader, textures):
+    #Readable debug version of a tag
+    return "%s/%s/vs:%s/ps:%s/%s" % (mode, image, getSourceDigest(vertexShader)[:8],
+        getSourceDigest(pixelShader)[:8], textures)
+
+#A context that has not been used for this many interactions is freed.
+#Allows a displayable to disappear for one interaction, like the old visibility check.
+FREE_AFTER_INTERACTIONS = 2
+
 class ControllerContext:
-    def __init__(self):
+    def __init__(self, generation, description=None):
+        self.description = description
         self.controller = None
         self.createCalled = False
         self.contextStore = {}
         self.modeChangeCount = 0
-        self.delayFree = False
+        self.generation = generation
         self.persist = False
         self.updateModeChangeCount()
 
@@ -47,56 +135,57 @@ class ControllerContext:
 
 
 class ControllerContextStore:
+    #Contexts are registered by tag when a displayable renders or takes part in an
+    #interaction. Each interaction starts a new generation, and contexts that have
+    #not been marked alive for a while are freed, so the scene is never searched.
+
     def __init__(self):
         self.store = {}
+        self.generation = 0
 
-    def get(self, tag):
+    def get(self, tag, description=None):
         context = self.store.get(tag, None)
         if not context:
-            context = ControllerContext()
+            context = ControllerContext(self.generation, description)
             self.store[tag] = context
+        return context
 
-        #context.delayFree = False #Not really needed...
+    def find(self, tag):
+        #Like get(), but doesn't create a new context
+        return self.store.get(tag, None)
 
-        return context
+    def getDescription(self, tag):
+        context = self.store.get(tag, None)
+        if context:
+            return context.description
+        return None
+
+    def mark(self, tag):
+        context = self.store.get(tag, None)
+        if context:
+            context.generation = self.generation
 
     def removeContext(self, tag):
         if tag in self.store:
             del self.store[tag]
+        shader._redrawScheduler.remove(tag)
 
-    def getAllShaderDisplayables(self, displayType):
-        displayables = []
-        for disp in renpy.exports.scene_lists().get_all_displayables():
-            try:
-                disp.visit_all(lambda x: displayables.append(x))
-            except AttributeError:
-                #TODO child is sometimes None somewhere, we could do this manually...
-                #Could renpy.showing(name, layer) work here?
-                pass
-        return [d for d in displayables if isinstance(d, displayType)]
-
-    def checkDisplayableVisibility(self, displayType):
-        tagged = {}
-        for d in self.getAllShaderDisplayables(displayType):
-            tagged[d.tag] = d
-
-        removal = []
-        for tag, context in self.store.items():
-            if context.delayFree:
-                if tag in tagged:
-                    #Went missing for one interaction, but now it is visible again.
-                    context.delayFree = False
-                else:
-                    removal.append((tag, context))
-            elif not tag in tagged and not context.persist:
-                #Not visible, free on next interaction
-                context.delayFree = True
-
-        for tag, context in removal:
+    def unregister(self, tag):
+        context = self.store.get(tag, None)
+        if context:
             context.freeController()
             self.removeContext(tag)
 
-        shader.log("Controller count: %s" % len(self.store))
+    def beginInteraction(self):
+        self.generation += 1
+        count = len(self.store)
+
+        for tag, context in self.store.items():
+            if not context.persist and self.generation - context.generation > FREE_AFTER_INTERACTIONS:
+                self.unregister(tag)
+
+        if len(self.store) != count:
+            shader.log("Controller count: %s" % len(self.store))
 
     def _clear(self):
         #Usually there is no need to call this in normal use
@@ -110,17 +199,36 @@ class RenderController(object):
     def __init__(self):
         self.renderer = None
         self.frameBuffer = None
-
-    def init(self, renderer):
+        self.droppedStateCalls = 0
+        self.cachedOutput = None
+        self.cachedFingerprint = None
+        self.unchangedFrames = 0
+        self.rendered = False #If the last renderOutput() rendered instead of using the cache
+        self.readback = None
+        self.handoff = None
+        self.surfaces = SurfacePool()
+
+    def init(self, renderer, readback=None, output=None):
         self.renderer = renderer
 
         w, h = self.renderer.getSize()
         self.frameBuffer = FrameBuffer(w, h, renderer.useDepth)
 
+        if (output or shader.config.output) == shader.OUTPUT_TEXTURE:
+            self.handoff = TextureHandoff.create()
+
+        if not self.handoff and (readback or shader.config.readback) == shader.READBACK_ASYNC:
+            self.readback = PixelBufferRing.create(w, h)
+
     def isValid(self):
         return self.renderer is not None
 
     def free(self):
+        self.cachedOutput = None
+        self.handoff = None
+        self.cachedFingerprint = None
+        self.surfaces.clear()
+
         if self.renderer:
             self.renderer.free()
             self.renderer = None
@@ -129,46 +237,271 @@ class RenderController(object):
             self.frameBuffer.free()
             self.frameBuffer = None
 
+        if self.readback:
+            self.readback.free()
+            self.readback = None
+
+    def restore(self):
+        #The OpenGL context was recreated and every handle we have belongs to the
+        #old one. Rebuild only the OpenGL objects from the data kept on the CPU side.
+        self.cachedOutput = None
+        self.cachedFingerprint = None
+        self.surfaces.clear()
+
+        self.renderer.invalidate()
+        self.frameBuffer.invalidate()
+        if self.readback:
+            self.readback.buffers = None
+
+        self.renderer.restore()
+        self.frameBuffer.restore()
+        if self.readback:
+            w, h = self.getSize()
+            self.readback = PixelBufferRing.create(w, h)
+
     def getSize(self):
         return self.renderer.getSize()
 
+    def renderOutput(self, context):
+        #Renders into a new texture or surface, or returns the previous one if the
+        #inputs that affect the output have not changed since it was rendered.
+        self.rendered = False
+        fingerprint = self.renderer.getFingerprint(context)
+        if fingerprint is not None and self.cachedOutput and fingerprint == self.cachedFingerprint:
+            if self.readback and self.readback.isPending():
+                #The cached surface is one frame behind, fetch the latest one
+                surface = self.surfaces.next(self.getSize())
+                self.readback.flush(surface)
+                self.cachedOutput = surface
+            self.unchangedFrames += 1
+            return self.cachedOutput
+
+        self.renderImage(context)
+        self.rendered = True
+
+        output = None
+        if self.handoff:
+            output = self.handoff.copy(self.frameBuffer, self.getSize())
+            if output is None:
+                #Don't try again, the surface path works everywhere
+                self.handoff = None
+
+        if output is None:
+            output = self.surfaces.next(self.getSize())
+            if not self.readback or not self.readback.transfer(self.frameBuffer.texture, output):
+                self.copyRenderBufferToSurface(output)
+
+        self.cachedOutput = output
+        self.cachedFingerprint = fingerprint
+        self.unchangedFrames = 0
+        return output
+
+    def isIdle(self):
+        return self.unchangedFrames > 0
+
     def renderImage(self, context):
+        state = glstate.tracker
+        state.begin()
+
         width, height = self.getSize()
         gl.glViewport(0, 0, width, height)
 
-        gl.glDisable(gl.GL_SCISSOR_TEST)
-
-        gl.glEnable(gl.GL_ALPHA_TEST)
-        gl.glAlphaFunc(gl.GL_GREATER, 0)
-
-        gl.glEnable(gl.GL_BLEND)
-        gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+        state.disable(gl.GL_SCISSOR_TEST)
 
-        self.frameBuffer.bind()
+        state.enable(gl.GL_ALPHA_TEST)
+        state.alphaFunc(gl.GL_GREATER, 0)
 
-        self.renderer.render(context)
+        state.enable(gl.GL_BLEND)
+        state.blendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
 
-        self.frameBuffer.unbind()
+        try:
+            self.frameBuffer.bind()
+            self.renderer.render(context)
+            self.frameBuffer.unbind()
+        finally:
+            #Restores the blend, capability, texture, program and framebuffer state Ren'Py expects
+            state.end()
 
-        #TODO Restore blend state. Any other states that need restoring...?
-        gl.glBlendFunc(gl.GL_ONE, gl.GL_ONE_MINUS_SRC_ALPHA)
+        self.droppedStateCalls = state.getStats()[1]
 
     def copyRenderBufferToSurface(self, surface):
         surface.lock()
 
         gl.glPixelStorei(gl.GL_PACK_ROW_LENGTH, surface.get_pitch() // surface.get_bytesize())
 
-        gl.glBindTexture(gl.GL_TEXTURE_2D, self.frameBuffer.texture)
+        glstate.tracker.bindTexture(0, self.frameBuffer.texture)
         gl.glGetTexImage(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, surface._pixels_address)
 
-        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        glstate.tracker.bindTexture(0, 0)
         gl.glPixelStorei(gl.GL_PACK_ROW_LENGTH, 0)
 
         surface.unlock()
 
 
+class SurfacePool:
+    #Output surfaces reused in turns. Ren'Py can still be holding the previously
+    #returned surface, so there must be at least two of them.
+
+    def __init__(self, count=2):
+        self.surfaces = [None] * max(count, 2)
+        self.index = 0
+
+    def clear(self):
+        self.surfaces = [None] * len(self.surfaces)
+
+    def next(self, size):
+        self.index = (self.index + 1) % len(self.surfaces)
+        surface = self.surfaces[self.index]
+        if surface is None or surface.get_size() != size:
+            surface = renpy.display.pgrender.surface(size, True)
+            self.surfaces[self.index] = surface
+        else:
+            #Drop the texture Ren'Py has cached for the old contents
+            renpy.display.render.mutated_surface(surface)
+        return surface
+
+
+class TextureHandoff:
+    #Copies the rendered image straight into a texture grid owned by Ren'Py's GL renderer,
+    #so the pixels never leave the GPU. Ren'Py calls the draw function with its own
+    #render-to-texture target bound, and the image is blitted into it from our framebuffer
+    #without touching any of the shader or vertex state Ren'Py keeps track of.
+    #This uses Ren'Py internals, so any failure falls back to a surface readback.
+
+    @classmethod
+    def create(cls):
+        draw = renpy.display.draw
+        try:
+            import renpy.gl.gltexture
+            supported = bool(gl.glBlitFramebuffer) and hasattr(renpy.gl.gltexture, "texture_grid_from_drawing") \
+                and hasattr(draw, "rtt") and hasattr(draw, "environ")
+        except Exception as e:
+            shader.log("Texture output not available: %s" % e)
+            return None
+
+        if not supported:
+            shader.log("Texture output not supported, using surface output")
+            return None
+        return cls()
+
+    def copy(self, frameBuffer, size):
+        #Returns a texture grid that can be blitted to a Render, or None on failure
+        width, height = size
+
+        def drawFunc(x, y, w, h):
+            previous = gl.GLint(0)
+            gl.glGetIntegerv(gl.GL_READ_FRAMEBUFFER_BINDING, ctypes.byref(previous))
+            gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, frameBuffer.buffer)
+            #The first row of our texture is the top of the image, like in Ren'Py's textures
+            gl.glBlitFramebuffer(x, y, x + w, y + h, 0, 0, w, h, gl.GL_COLOR_BUFFER_BIT, gl.GL_NEAREST)
+            gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, previous.value)
+
+        draw = renpy.display.draw
+        try:
+            return renpy.gl.gltexture.texture_grid_from_drawing(width, height, drawFunc, draw.rtt, draw.environ)
+        except Exception as e:
+            shader.log("Texture output failed, using surface output: %s" % e)
+            return None
+
+
+class PixelBufferRing:
+    #Asynchronous readback through pixel buffer objects. The frame rendered now is copied into
+    #a buffer on the GPU side while the buffer filled during the previous frame is mapped and
+    #copied into the surface, so the CPU does not have to wait for the GPU to finish.
+    #This adds one frame of latency.
+
+    def __init__(self, width, height, count):
+        self.width = width
+        self.height = height
+        self.size = 0
+        self.index = 0
+        self.pending = 0
+        self.buffers = (gl.GLuint * count)()
+        gl.glGenBuffers(count, self.buffers)
+
+    @classmethod
+    def create(cls, width, height, count=2):
+        if not bool(gl.glGenBuffers) or not bool(gl.glMapBuffer):
+            shader.log("Pixel buffer objects not supported, using synchronous readback")
+            return None
+
+        try:
+            return cls(width, height, count)
+        except gl.GLError as e:
+            shader.log("Pixel buffer object creation failed, using synchronous readback: %s" % e)
+            return None
+
+    def free(self):
+        if self.buffers:
+            gl.glDeleteBuffers(len(self.buffers), self.buffers)
+            self.buffers = None
+
+    def isPending(self):
+        return self.pending > 0
+
+    def allocate(self, size):
+        for buffer in self.buffers:
+            gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, buffer)
+            gl.glBufferData(gl.GL_PIXEL_PACK_BUFFER, size, None, gl.GL_STREAM_READ)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+        self.size = size
+
+    def transfer(self, texture, surface):
+        #Returns False if there was no finished frame to copy into the surface yet
+        pitch = surface.get_pitch()
+        size = pitch * self.height
+        if size != self.size:
+            self.allocate(size)
+            self.pending = 0
+
+        gl.glPixelStorei(gl.GL_PACK_ROW_LENGTH, pitch // surface.get_bytesize())
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, self.buffers[self.index])
+        glstate.tracker.bindTexture(0, texture)
+        gl.glGetTexImage(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        glstate.tracker.bindTexture(0, 0)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+        gl.glPixelStorei(gl.GL_PACK_ROW_LENGTH, 0)
+
+        previous = (self.index - 1) % len(self.buffers)
+        self.index = (self.index + 1) % len(self.buffers)
+        self.pending = min(self.pending + 1, len(self.buffers))
+
+        if self.pending < 2:
+            return False
+
+        self.copyToSurface(self.buffers[previous], surface)
+        self.pending -= 1
+        return True
+
+    def flush(self, surface):
+        latest = (self.index - 1) % len(self.buffers)
+        self.copyToSurface(self.buffers[latest], surface)
+        self.pending = 0
+
+    def copyToSurface(self, buffer, surface):
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, buffer)
+        pointer = gl.glMapBuffer(gl.GL_PIXEL_PACK_BUFFER, gl.GL_READ_ONLY)
+        if pointer:
+            address = ctypes.cast(pointer, ctypes.c_void_p).value
+            surface.lock()
+            ctypes.memmove(surface._pixels_address, address, self.size)
+            surface.unlock()
+            gl.glUnmapBuffer(gl.GL_PIXEL_PACK_BUFFER)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+
+
 class FrameBuffer:
     def __init__(self, width, height, depth=False):
+        self.width = width
+        self.height = height
+        self.depth = depth
+        self.create()
+
+    def create(self):
+        width = self.width
+        height = self.height
+        depth = self.depth
+
         self.texture = self.createEmptyTexture(width, height)
         if self.texture == 0:
             raise RuntimeError("Can't create FrameBuffer textures")
@@ -185,6 +518,7 @@ class FrameBuffer:
 
     def free(self):
         if self.texture:
+            glstate.tracker.forgetTexture(self.texture)
             gl.glDeleteTextures(1, self.texture)
             self.texture = 0
         if self.depthBuffer:
@@ -194,17 +528,26 @@ class FrameBuffer:
             gl.glDeleteFramebuffers(1, self.buffer)
             self.buffer = 0
 
+    def invalidate(self):
+        glstate.tracker.forgetTexture(self.texture)
+        self.texture = 0
+        self.depthBuffer = 0
+        self.buffer = 0
+
+    def restore(self):
+        self.create()
+
     def createEmptyTexture(self, width, height):
         textureId = (gl.GLuint * 1)()
         gl.glGenTextures(1, textureId)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, textureId[0])
+        glstate.tracker.bindTexture(0, textureId[0])
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T, gl.GL_CLAMP_TO_EDGE)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
         #None means reserve texture memory, but texels are undefined
         gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA8, width, height, 0, gl.GL_BGRA, gl.GL_UNSIGNED_BYTE, None)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        glstate.tracker.bindTexture(0, 0)
         return textureId[0]
 
     def createDepthBuffer(self, width, height):
@@ -218,16 +561,16 @@ class FrameBuffer:
     def createFrameBuffer(self, texture, depthBuffer):
         bufferId = (gl.GLuint * 1)()
         gl.glGenFramebuffers(1, bufferId);
-        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, bufferId[0])
+        glstate.tracker.bindFrameBuffer(bufferId[0])
         gl.glFramebufferTexture2D(gl.GL_FRAMEBUFFER, gl.GL_COLOR_ATTACHMENT0, gl.GL_TEXTURE_2D, texture, 0)
         if depthBuffer:
             gl.glFramebufferRenderbuffer(gl.GL_FRAMEBUFFER, gl.GL_DEPTH_ATTACHMENT, gl.GL_RENDERBUFFER, depthBuffer);
-        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
+        glstate.tracker.bindFrameBuffer(0)
         return bufferId[0]
 
     def bind(self):
-        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.buffer)
+        glstate.tracker.bindFrameBuffer(self.buffer)
 
     def unbind(self):
-        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
+        glstate.tracker.bindFrameBuffer(0)
 
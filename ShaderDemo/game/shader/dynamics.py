@@ -0,0 +1,145 @@
+
+#Secondary motion for damped bones. The pivot of every damped bone is simulated
+#as a point on a damped spring that follows where the pose puts the pivot. The
+#difference between the two is added to the translation of the bone, so the
+#bone lags behind quick movements and settles with a small overshoot.
+#
+#The simulation runs at a fixed time step independent of the frame rate, all
+#damped bones are stepped together over flat lists of x and y components.
+#At most MAX_STEPS steps are taken per frame, if a frame takes longer than that
+#the simulation slows down instead of costing more.
+
+STEP = 1.0 / 60.0
+MAX_STEPS = 8
+FREQUENCY = 6.0 #Angular frequency of the spring times the damping of the bone
+MAX_FREQUENCY = 1.0 / STEP #Stiffer springs would not be stable at STEP
+DAMPING_RATIO = 0.4 #Below 1.0 the spring overshoots a little
+REST_DISTANCE = 0.01 #Pixels, closer than this the spring is snapped to its target
+
+def getPivotPosition(transform):
+    #Same as transforming the pivot with transform.matrix
+    px, py = transform.bone.pivot
+    world = transform.world
+    i = transform.offset
+    if world is None:
+        m = transform.matrix
+        return m.a * px + m.b * py + m.d, m.e * px + m.f * py + m.h
+    return (world[i] * px + world[i + 1] * py + world[i + 3],
+        world[i + 4] * px + world[i + 5] * py + world[i + 7])
+
+def getSpringConstants(damping):
+    #Returns the stiffness and friction of a spring for the damping of a bone
+    frequency = min(FREQUENCY / damping, MAX_FREQUENCY)
+    return frequency * frequency, 2.0 * DAMPING_RATIO * frequency
+
+
+class SpringSolver:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.names = [] #Damped bones in simulation order
+        self.positions = [] #x and y of every bone, one after another
+        self.velocities = []
+        self.stiffness = [] #Per component, like positions
+        self.friction = []
+        self.dampings = []
+        self.resting = True
+        self.time = None
+
+        #Counters for checking the cost
+        self.steps = 0 #Steps taken in the last update
+        self.totalSteps = 0
+        self.droppedTime = 0.0 #Seconds skipped because a frame took too long
+
+    def update(self, transforms, time):
+        #Advances the simulation to time and returns the (x, y) offset for every
+        #transform in transforms, None for those which are not damped.
+        damped = [(i, transform) for i, transform in enumerate(transforms) if transform.damping > 0.0]
+        targets = []
+        for i, transform in damped:
+            targets.extend(getPivotPosition(transform))
+
+        self.updateBones([transform for i, transform in damped], targets)
+        self.advance(time, targets)
+
+        offsets = [None] * len(transforms)
+        positions = self.positions
+        for n, (i, transform) in enumerate(damped):
+            x = n * 2
+            offsets[i] = (positions[x] - targets[x], positions[x + 1] - targets[x + 1])
+        return offsets
+
+    def updateBones(self, transforms, targets):
+        names = [transform.bone.name for transform in transforms]
+        if names != self.names:
+            #Bones that are still damped keep their state, new ones start at rest
+            old = dict((name, n) for n, name in enumerate(self.names))
+            positions = targets[:]
+            velocities = [0.0] * len(targets)
+            for n, name in enumerate(names):
+                index = old.get(name)
+                if index is not None:
+                    positions[n * 2:n * 2 + 2] = self.positions[index * 2:index * 2 + 2]
+                    velocities[n * 2:n * 2 + 2] = self.velocities[index * 2:index * 2 + 2]
+            self.names = names
+            self.positions = positions
+            self.velocities = velocities
+            self.dampings = None
+
+        dampings = [transform.damping for transform in transforms]
+        if dampings != self.dampings:
+            self.dampings = dampings
+            self.stiffness = []
+            self.friction = []
+            for damping in dampings:
+                stiffness, friction = getSpringConstants(damping)
+                self.stiffness.extend((stiffness, stiffness))
+                self.friction.extend((friction, friction))
+
+    def advance(self, time, targets):
+        time = float(time)
+        if self.time is None or time < self.time:
+            #Shown again, start from the current pose
+            self.time = time
+            self.positions = targets[:]
+            self.velocities = [0.0] * len(targets)
+            self.resting = True
+
+        steps = int((time - self.time) / STEP + 1e-6) #Not a step behind because of rounding
+        if steps > MAX_STEPS:
+            self.droppedTime += (steps - MAX_STEPS) * STEP
+            self.time += (steps - MAX_STEPS) * STEP
+            steps = MAX_STEPS
+        self.time += steps * STEP
+        self.steps = steps
+        self.totalSteps += steps
+
+        if self.positions != targets:
+            #The pose has moved away from the springs
+            self.resting = False
+        if steps == 0 or self.resting:
+            return
+
+        positions = self.positions
+        velocities = self.velocities
+        stiffness = self.stiffness
+        friction = self.friction
+        for step in range(steps):
+            #Semi-implicit Euler, the velocity is updated first
+            velocities = [v + (k * (t - p) - c * v) * STEP
+                for p, v, t, k, c in zip(positions, velocities, targets, stiffness, friction)]
+            positions = [p + v * STEP for p, v in zip(positions, velocities)]
+
+        self.resting = self.isResting(positions, velocities, targets)
+        if self.resting:
+            positions = targets[:]
+            velocities = [0.0] * len(targets)
+        self.positions = positions
+        self.velocities = velocities
+
+    def isResting(self, positions, velocities, targets):
+        for p, v, t in zip(positions, velocities, targets):
+            if abs(p - t) > REST_DISTANCE or abs(v) * STEP > REST_DISTANCE:
+                return False
+        return True
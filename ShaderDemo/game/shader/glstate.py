@@ -0,0 +1,140 @@
+
+from OpenGL import GL as gl
+
+#Capabilities whose state is saved when a frame starts and restored when it ends
+RESTORED_CAPABILITIES = (gl.GL_BLEND, gl.GL_ALPHA_TEST, gl.GL_SCISSOR_TEST, gl.GL_DEPTH_TEST)
+
+#Ren'Py draws with premultiplied alpha
+RENPY_BLEND_FUNC = (gl.GL_ONE, gl.GL_ONE_MINUS_SRC_ALPHA)
+
+#Filters out redundant OpenGL state changes during a frame. Outside of begin() and end()
+#every call is passed through as is, because Ren'Py can change the state between frames.
+
+class StateTracker:
+    def __init__(self):
+        self.active = False
+        self.capabilities = {}
+        self.saved = {}
+        self.textures = {}
+        self.activeUnit = None
+        self.program = None
+        self.frameBuffer = None
+        self.blend = None
+        self.alpha = None
+        self.calls = 0
+        self.dropped = 0
+        self.lastCalls = 0
+        self.lastDropped = 0
+
+    def begin(self):
+        self.clear()
+        self.active = True
+        self.calls = 0
+        self.dropped = 0
+        for cap in RESTORED_CAPABILITIES:
+            enabled = bool(gl.glIsEnabled(cap))
+            self.saved[cap] = enabled
+            self.capabilities[cap] = enabled
+
+    def end(self):
+        for cap, enabled in self.saved.items():
+            self.setCapability(cap, enabled)
+        self.blendFunc(*RENPY_BLEND_FUNC)
+
+        for unit in self.textures.keys():
+            self.bindTexture(unit, 0)
+        self.activeTexture(0)
+        self.bindFrameBuffer(0)
+        self.useProgram(0)
+
+        self.lastCalls = self.calls
+        self.lastDropped = self.dropped
+        self.active = False
+        self.clear()
+
+    def clear(self):
+        self.capabilities.clear()
+        self.saved.clear()
+        self.textures.clear()
+        self.activeUnit = None
+        self.program = None
+        self.frameBuffer = None
+        self.blend = None
+        self.alpha = None
+
+    def getStats(self):
+        #Calls made and dropped during the last frame
+        return self.lastCalls, self.lastDropped
+
+    def isCached(self, current, value):
+        self.calls += 1
+        if self.active and current == value:
+            self.dropped += 1
+            return True
+        return False
+
+    def enable(self, cap):
+        self.setCapability(cap, True)
+
+    def disable(self, cap):
+        self.setCapability(cap, False)
+
+    def setCapability(self, cap, enabled):
+        if self.isCached(self.capabilities.get(cap), enabled):
+            return
+        if enabled:
+            gl.glEnable(cap)
+        else:
+            gl.glDisable(cap)
+        self.capabilities[cap] = enabled
+
+    def blendFunc(self, source, target):
+        value = (source, target)
+        if self.isCached(self.blend, value):
+            return
+        gl.glBlendFunc(source, target)
+        self.blend = value
+
+    def alphaFunc(self, func, ref):
+        value = (func, ref)
+        if self.isCached(self.alpha, value):
+            return
+        gl.glAlphaFunc(func, ref)
+        self.alpha = value
+
+    def activeTexture(self, unit):
+        if self.isCached(self.activeUnit, unit):
+            return
+        gl.glActiveTexture(gl.GL_TEXTURE0 + unit)
+        self.activeUnit = unit
+
+    def bindTexture(self, unit, texture):
+        if self.isCached(self.textures.get(unit), texture):
+            return
+        self.activeTexture(unit)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, texture)
+        self.textures[unit] = texture
+
+    def bindFrameBuffer(self, buffer):
+        if self.isCached(self.frameBuffer, buffer):
+            return
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, buffer)
+        self.frameBuffer = buffer
+
+    def useProgram(self, program):
+        if self.isCached(self.program, program):
+            return
+        gl.glUseProgram(program)
+        self.program = program
+
+    def forgetProgram(self, program):
+        #Deleting a program in use makes the cached handle meaningless
+        if self.program == program:
+            self.program = None
+
+    def forgetTexture(self, texture):
+        for unit, bound in self.textures.items():
+            if bound == texture:
+                del self.textures[unit]
+
+tracker = StateTracker()
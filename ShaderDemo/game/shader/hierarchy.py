@@ -0,0 +1,255 @@
+
+#Bone hierarchy flattened into arrays. Bones are ordered so that every parent
+#comes before its children, local transforms are computed from the pose into
+#a float array and world transforms are then evaluated in one pass in that order.
+#
+#Matrices are affine 3x4, stored row by row as 12 floats per bone:
+#   a b c d
+#   e f g h
+#   i j k l
+#The same as the top three rows of a euclid.Matrix4, the last row is always 0 0 0 1.
+#
+#While no bone is tilted (rotated around x or y) c, g, i, j and l stay zero and
+#only the 2D affine part a b d / e f h and the z scale k need to be composed.
+
+import math
+
+import euclid
+
+MATRIX_SIZE = 12
+
+def getStructureKey(bones, root):
+    #Changes whenever bones are added, removed, replaced or moved in the hierarchy
+    return (id(root), tuple([(id(bone), tuple(bone.children)) for bone in bones.values()]))
+
+def toMatrix4(data, offset):
+    m = euclid.Matrix4()
+    (m.a, m.b, m.c, m.d,
+     m.e, m.f, m.g, m.h,
+     m.i, m.j, m.k, m.l) = data[offset:offset + MATRIX_SIZE]
+    return m
+
+def setLocalMatrix(data, offset, bone):
+    #Same as translating to the pivot, translating, rotating around y, x and z,
+    #scaling and translating back from the pivot with euclid.Matrix4
+    px, py = bone.pivot
+    rotation = bone.rotation
+    scale = bone.scale
+    rx = rotation.x
+    ry = rotation.y
+    rz = rotation.z
+
+    if rx == 0.0 and ry == 0.0:
+        #Common case, only a rotation around z
+        cz = math.cos(rz)
+        sz = math.sin(rz)
+        r00 = cz
+        r01 = -sz
+        r02 = 0.0
+        r10 = sz
+        r11 = cz
+        r12 = 0.0
+        r20 = 0.0
+        r21 = 0.0
+        r22 = 1.0
+    else:
+        cx = math.cos(rx)
+        sx = math.sin(rx)
+        cy = math.cos(ry)
+        sy = math.sin(ry)
+        cz = math.cos(rz)
+        sz = math.sin(rz)
+        r00 = cy * cz + sy * sx * sz
+        r01 = -cy * sz + sy * sx * cz
+        r02 = sy * cx
+        r10 = cx * sz
+        r11 = cx * cz
+        r12 = -sx
+        r20 = -sy * cz + cy * sx * sz
+        r21 = sy * sz + cy * sx * cz
+        r22 = cy * cx
+
+    scaleX = scale.x
+    scaleY = scale.y
+    scaleZ = scale.z
+    r00 *= scaleX
+    r10 *= scaleX
+    r20 *= scaleX
+    r01 *= scaleY
+    r11 *= scaleY
+    r21 *= scaleY
+    r02 *= scaleZ
+    r12 *= scaleZ
+    r22 *= scaleZ
+
+    translation = bone.translation
+    data[offset:offset + MATRIX_SIZE] = (
+        r00, r01, r02, px + translation.x - (r00 * px + r01 * py),
+        r10, r11, r12, py + translation.y - (r10 * px + r11 * py),
+        r20, r21, r22, -(r20 * px + r21 * py))
+
+
+def getLocalKey(bone):
+    #Everything the local matrix, damping and transparency of a bone depend on
+    pivot = bone.pivot
+    translation = bone.translation
+    rotation = bone.rotation
+    scale = bone.scale
+    return (pivot[0], pivot[1], translation.x, translation.y, rotation.x, rotation.y, rotation.z,
+        scale.x, scale.y, scale.z, bone.damping, bone.transparency)
+
+
+class BoneHierarchy:
+    def __init__(self):
+        self.key = None
+        self.bones = [] #In parent before child order
+        self.parents = [] #Index of the parent in bones, -1 for the root
+        self.localKeys = [] #Pose of every bone when its local matrix was last computed
+        self.dirty = [] #Bones whose world matrix changed in the last evaluation
+        self.tilted = [] #Bones rotated around x or y
+        self.tiltCount = 0
+        self.local = []
+        self.world = [] #Of the last evaluation
+        self.damping = []
+        self.transparency = []
+
+        #Counters for checking how much work the dirty tracking saves
+        self.recomputed = 0 #Bones whose world matrix was recomputed in the last evaluation
+        self.totalRecomputed = 0
+        self.totalBones = 0
+        self.evaluations = 0
+
+    def update(self, bones, root):
+        #Recompiles the order if the structure of the hierarchy has changed
+        key = getStructureKey(bones, root)
+        if key != self.key:
+            self.compile(bones, root)
+            self.key = key
+
+    def compile(self, bones, root):
+        order = []
+        parents = []
+        stack = [(root, -1)]
+        while stack:
+            bone, parent = stack.pop()
+            parents.append(parent)
+            index = len(order)
+            order.append(bone)
+            #Reversed so that children are visited in the same order as by recursion
+            for name in reversed(bone.children):
+                stack.append((bones[name], index))
+
+        count = len(order)
+        self.bones = order
+        self.parents = parents
+        self.localKeys = [None] * count #Everything is dirty
+        self.dirty = [True] * count
+        self.tilted = [False] * count
+        self.tiltCount = 0
+        self.local = [0.0] * (count * MATRIX_SIZE)
+        self.world = [0.0] * (count * MATRIX_SIZE)
+        self.damping = [0.0] * count
+        self.transparency = [0.0] * count
+
+    def getSavings(self):
+        #Fraction of world matrix updates skipped since the start
+        if not self.totalBones:
+            return 0.0
+        return 1.0 - self.totalRecomputed / float(self.totalBones)
+
+    def isFlat(self):
+        #True if all transforms are 2D affine
+        return self.tiltCount == 0
+
+    def updateLocal(self, index, bone):
+        #Returns True if the pose of the bone has changed
+        key = getLocalKey(bone)
+        if key == self.localKeys[index]:
+            return False
+
+        self.localKeys[index] = key
+        setLocalMatrix(self.local, index * MATRIX_SIZE, bone)
+
+        tilted = bone.rotation.x != 0.0 or bone.rotation.y != 0.0
+        if tilted != self.tilted[index]:
+            self.tilted[index] = tilted
+            self.tiltCount += 1 if tilted else -1
+        return True
+
+    def evaluate(self):
+        #Returns the world matrices of all bones. Only bones whose pose changed and
+        #their children are recomputed. A new list every time, so that transforms
+        #of earlier frames can still refer to theirs.
+        bones = self.bones
+        parents = self.parents
+        dirty = self.dirty
+
+        #Local matrices first, tilting a bone changes how everything is composed
+        changed = [self.updateLocal(index, bone) for index, bone in enumerate(bones)]
+        flat = self.isFlat()
+
+        local = self.local
+        world = self.world[:]
+        damping = self.damping
+        transparency = self.transparency
+        recomputed = 0
+
+        for index, bone in enumerate(bones):
+            parent = parents[index]
+            if not changed[index] and (parent < 0 or not dirty[parent]):
+                #Neither this bone nor any of its parents changed
+                dirty[index] = False
+                continue
+
+            dirty[index] = True
+            recomputed += 1
+            offset = index * MATRIX_SIZE
+
+            if parent < 0:
+                world[offset:offset + MATRIX_SIZE] = local[offset:offset + MATRIX_SIZE]
+                damping[index] = bone.damping
+                transparency[index] = bone.transparency
+                continue
+
+            p = parent * MATRIX_SIZE
+            if flat:
+                la, lb, ld = local[offset], local[offset + 1], local[offset + 3]
+                le, lf, lh = local[offset + 4], local[offset + 5], local[offset + 7]
+                pa, pb, pd = world[p], world[p + 1], world[p + 3]
+                pe, pf, ph = world[p + 4], world[p + 5], world[p + 7]
+
+                world[offset:offset + MATRIX_SIZE] = (
+                    pa * la + pb * le, pa * lb + pb * lf, 0.0, pa * ld + pb * lh + pd,
+                    pe * la + pf * le, pe * lb + pf * lf, 0.0, pe * ld + pf * lh + ph,
+                    0.0, 0.0, world[p + 10] * local[offset + 10], 0.0)
+            else:
+                (la, lb, lc, ld,
+                 le, lf, lg, lh,
+                 li, lj, lk, ll) = local[offset:offset + MATRIX_SIZE]
+                (pa, pb, pc, pd,
+                 pe, pf, pg, ph,
+                 pi, pj, pk, pl) = world[p:p + MATRIX_SIZE]
+
+                world[offset:offset + MATRIX_SIZE] = (
+                    pa * la + pb * le + pc * li,
+                    pa * lb + pb * lf + pc * lj,
+                    pa * lc + pb * lg + pc * lk,
+                    pa * ld + pb * lh + pc * ll + pd,
+                    pe * la + pf * le + pg * li,
+                    pe * lb + pf * lf + pg * lj,
+                    pe * lc + pf * lg + pg * lk,
+                    pe * ld + pf * lh + pg * ll + ph,
+                    pi * la + pj * le + pk * li,
+                    pi * lb + pj * lf + pk * lj,
+                    pi * lc + pj * lg + pk * lk,
+                    pi * ld + pj * lh + pk * ll + pl)
+
+            damping[index] = max(bone.damping, damping[parent])
+            transparency[index] = 1 - ((1 - bone.transparency) * (1 - transparency[parent]))
+
+        self.recomputed = recomputed
+        self.totalRecomputed += recomputed
+        self.totalBones += len(self.bones)
+        self.evaluations += 1
+        self.world = world
+        return world
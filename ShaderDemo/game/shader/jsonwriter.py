@@ -0,0 +1,200 @@
+
+#Writes JSON straight into a file without building the document in memory first.
+#Objects are laid out like json.dump() with indent=1, but arrays of numbers are
+#written compactly on one line. Has no dependencies outside the standard library.
+
+import os
+import sys
+import json
+import ctypes
+import tempfile
+
+INDENT = " "
+
+NUMBER_TYPES = (int, float)
+if sys.version_info[0] < 3:
+    NUMBER_TYPES += (long,)
+    STRING_TYPES = (str, unicode)
+else:
+    STRING_TYPES = (str,)
+
+encodeString = json.encoder.encode_basestring_ascii
+
+def getSlots(cls):
+    slots = []
+    for base in reversed(cls.__mro__):
+        names = base.__dict__.get("__slots__", ())
+        if isinstance(names, STRING_TYPES):
+            names = (names,)
+        slots.extend(names)
+    return slots
+
+def getFieldNames(obj):
+    #Instance attributes, or slots for classes that use them. A slot starting
+    #with an underscore is the storage of a property with the name without it.
+    if hasattr(obj, "__dict__"):
+        return list(obj.__dict__)
+    return [name.lstrip("_") for name in getSlots(type(obj))]
+
+def getFields(obj, ignores=()):
+    #Fields of an object for JsonWriter, sorted like json.dump(sort_keys=True)
+    for key in sorted(getFieldNames(obj)):
+        if key not in ignores:
+            yield key, getattr(obj, key)
+
+def isNumber(value):
+    return isinstance(value, NUMBER_TYPES) and not isinstance(value, bool)
+
+def isNumberList(values):
+    for value in values:
+        if not isNumber(value):
+            return False
+    return True
+
+def isCompact(values):
+    #Lists of numbers and lists of points are written on one line
+    for value in values:
+        if isinstance(value, (list, tuple)):
+            if not isNumberList(value):
+                return False
+        elif not isNumber(value):
+            return False
+    return True
+
+def formatNumber(value):
+    if isinstance(value, float):
+        if value != value or value in (float("inf"), float("-inf")):
+            return json.dumps(value)
+        return repr(value)
+    return str(value)
+
+class JsonWriter:
+    #The convert function is called with objects that are not JSON types. It should
+    #return a list or tuple to write as an array, or (key, value) pairs to write
+    #as an object. The packArray function can return a replacement for a ctypes
+    #array, None writes the numbers.
+
+    def __init__(self, f, convert=None, packArray=None):
+        self.f = f
+        self.convert = convert
+        self.packArray = packArray
+
+    def write(self, obj):
+        self.writeValue(obj, 0)
+        self.f.write("\n")
+
+    def writeValue(self, obj, level):
+        write = self.f.write
+        if obj is None:
+            write("null")
+        elif obj is True:
+            write("true")
+        elif obj is False:
+            write("false")
+        elif isinstance(obj, STRING_TYPES):
+            write(encodeString(obj))
+        elif isinstance(obj, NUMBER_TYPES):
+            write(formatNumber(obj))
+        elif isinstance(obj, dict):
+            self.writeObject(sorted(obj.items(), key=lambda item: item[0]), level)
+        elif isinstance(obj, (list, tuple)):
+            self.writeArray(obj, level)
+        elif isinstance(obj, ctypes.Array):
+            self.writeCtypesArray(obj, level)
+        elif self.convert:
+            value = self.convert(obj)
+            if isinstance(value, (list, tuple)):
+                self.writeArray(value, level)
+            else:
+                self.writeObject(value, level)
+        else:
+            raise TypeError("Can't write %r as JSON" % obj)
+
+    def writeObject(self, items, level):
+        write = self.f.write
+        separator = "{"
+        for key, value in items:
+            write(separator)
+            write("\n" + INDENT * (level + 1))
+            write(encodeString(key))
+            write(": ")
+            self.writeValue(value, level + 1)
+            separator = ","
+
+        if separator == "{":
+            write("{}")
+        else:
+            write("\n" + INDENT * level + "}")
+
+    def writeArray(self, values, level):
+        write = self.f.write
+        if not values:
+            write("[]")
+        elif isCompact(values):
+            write("[" + ",".join([self.formatCompact(value) for value in values]) + "]")
+        else:
+            separator = "["
+            for value in values:
+                write(separator)
+                write("\n" + INDENT * (level + 1))
+                self.writeValue(value, level + 1)
+                separator = ","
+            write("\n" + INDENT * level + "]")
+
+    def formatCompact(self, value):
+        if isinstance(value, (list, tuple)):
+            return "[" + ",".join([formatNumber(v) for v in value]) + "]"
+        return formatNumber(value)
+
+    def writeCtypesArray(self, values, level):
+        packed = None
+        if self.packArray:
+            packed = self.packArray(values)
+        if packed is not None:
+            self.writeValue(packed, level)
+        else:
+            self.writeArray(values[:], level)
+
+def toWidePath(path):
+    if sys.version_info[0] < 3 and isinstance(path, str):
+        return path.decode(sys.getfilesystemencoding())
+    return path
+
+MOVEFILE_REPLACE_EXISTING = 0x1
+MOVEFILE_WRITE_THROUGH = 0x8
+
+def replaceFile(source, target):
+    #Atomic, the target is either the old or the new file even after a crash
+    if os.name != "nt":
+        os.rename(source, target)
+        return
+
+    #os.rename() can't replace an existing file on Windows
+    flags = MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH
+    if not ctypes.windll.kernel32.MoveFileExW(toWidePath(source), toWidePath(target), flags):
+        raise ctypes.WinError()
+
+def getFileMode(path):
+    #Keeps the permissions of the file being replaced, temporary files are private
+    if os.path.exists(path):
+        return os.stat(path).st_mode & 0o777
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+def save(obj, path, convert=None, packArray=None):
+    #Writes into a temporary file first and then renames it over the target,
+    #so a failed save never leaves a partially written file behind
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(handle, "w") as f:
+            JsonWriter(f, convert, packArray).write(obj)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp, getFileMode(path))
+        replaceFile(temp, path)
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
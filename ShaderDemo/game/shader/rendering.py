@@ -8,36 +8,135 @@ from OpenGL import GL as gl
 import euclid
 import math
 import json
+import itertools
+import threading
+import collections
 
 import shader
 import shadercode
+import glstate
+import tasks
+import hierarchy
+import dynamics
 import mesh
 import utils
 import skin
 
+_textureGenerations = itertools.count(1)
+
+def getSurfaceBytes(surface):
+    return surface.get_pitch() * surface.get_height()
+
+SUBSURFACE_MIN_AREA = 0.5 #Smaller crops of a cached image are copied
+
+class SurfaceCache:
+    #Decoded images shared by all rig loads, so an image used by many bones is
+    #decoded only once. Least recently used images are dropped when over budget.
+    #Bone images are copied out unless they cover most of the source. The budget
+    #doesn't count dropped images that are still in use: atlases and sources
+    #mostly covered by one bone.
+
+    def __init__(self):
+        self.surfaces = collections.OrderedDict()
+        self.loading = {} #Event and result of images being decoded
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        #Can be called from a background thread. Images are decoded outside of
+        #the lock, callers that want an image while it is decoding wait for it.
+        while True:
+            with self.lock:
+                surface = self.surfaces.pop(name, None)
+                if surface is not None:
+                    self.surfaces[name] = surface
+                    return surface
+                loading = self.loading.get(name)
+                if not loading:
+                    loading = (threading.Event(), [])
+                    self.loading[name] = loading
+                    break
+            event, result = loading
+            event.wait()
+            if result:
+                return result[0]
+            #The other decode failed, try again
+
+        event, result = loading
+        try:
+            surface = renpy.display.im.load_surface(renpy.exports.displayable(name))
+            result.append(surface)
+            with self.lock:
+                self.surfaces[name] = surface
+                self.size += getSurfaceBytes(surface)
+                self.trim()
+            return surface
+        finally:
+            with self.lock:
+                del self.loading[name]
+            event.set()
+
+    def trim(self):
+        while self.size > shader.config.surfaceCacheSize and len(self.surfaces) > 1:
+            name, surface = self.surfaces.popitem(last=False)
+            self.size -= getSurfaceBytes(surface)
+
+    def clear(self):
+        with self.lock:
+            self.surfaces.clear()
+            self.size = 0
+
 class TextureEntry:
-    def __init__(self, image, sampler):
+    def __init__(self, image, sampler, upload=True):
         self.sampler = sampler
+        self.generation = next(_textureGenerations)
+        self.glTexture = 0
+        self.pending = None
 
         if isinstance(image, (pygame.Surface)):
             self.image = None
-            surface = image
+            #Kept so the texture can be restored after a context loss
+            self.surface = image
         else:
             self.image = image
-            surface = renpy.display.im.load_surface(self.image)
+            self.surface = None
 
+        if upload:
+            self.upload()
+        else:
+            #Decode now, possibly in a background thread, and upload later
+            self.pending = self.loadSurface()
+            self.width, self.height = self.pending.get_size()
+
+    def loadSurface(self):
+        if self.surface:
+            return self.surface
+        return renpy.display.im.load_surface(self.image)
+
+    def upload(self):
+        surface = self.pending or self.loadSurface()
+        self.pending = None
         self.glTexture, self.width, self.height = utils.glTextureFromSurface(surface)
         if self.glTexture == 0:
-            raise RuntimeError("Can't load gl texture from image: %s" % image)
+            raise RuntimeError("Can't load gl texture from image: %s" % (self.image or self.surface))
 
     def free(self):
         if self.glTexture:
+            glstate.tracker.forgetTexture(self.glTexture)
             gl.glDeleteTextures(1, self.glTexture)
             self.glTexture = 0
 
+    def invalidate(self):
+        glstate.tracker.forgetTexture(self.glTexture)
+        self.glTexture = 0
+
+    def restore(self):
+        self.upload()
+
 class TextureMap:
     def __init__(self):
         self.textures = {}
+        self.deferred = False #If set, new textures are only uploaded by uploadPending()
 
     def free(self):
         for sampler, entry in self.textures.items():
@@ -45,25 +144,39 @@ class TextureMap:
         self.textures.clear()
 
     def setTexture(self, sampler, image):
-        entry = TextureEntry(image, sampler)
+        entry = TextureEntry(image, sampler, not self.deferred)
         old = self.textures.get(sampler)
         if old:
             old.free()
         self.textures[sampler] = entry
 
+    def uploadPending(self):
+        for entry in self.textures.values():
+            if not entry.glTexture:
+                entry.upload()
+
+    def invalidate(self):
+        for entry in self.textures.values():
+            entry.invalidate()
+
+    def restore(self):
+        for entry in self.textures.values():
+            entry.restore()
+
+    def getGenerations(self):
+        return tuple(sorted((sampler, entry.generation) for sampler, entry in self.textures.items()))
+
     def bindTextures(self, shader):
         index = 0
         for sampler, entry in self.textures.items():
             shader.uniformi(sampler, index)
-            gl.glActiveTexture(gl.GL_TEXTURE0 + index)
-            gl.glBindTexture(gl.GL_TEXTURE_2D, entry.glTexture)
+            glstate.tracker.bindTexture(index, entry.glTexture)
             index += 1
 
     def unbindTextures(self):
         for i in range(len(self.textures)):
-            gl.glActiveTexture(gl.GL_TEXTURE0 + i)
-            gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
-        gl.glActiveTexture(gl.GL_TEXTURE0)
+            glstate.tracker.bindTexture(i, 0)
+        glstate.tracker.activeTexture(0)
 
 
 class BaseRenderer(object):
@@ -71,6 +184,19 @@ class BaseRenderer(object):
         self.useDepth = False
         self.clearColor = (0, 0, 0, 0)
 
+    def getUniformFingerprint(self, shader, uniforms):
+        #Only uniforms the shader actually uses can change the image
+        values = []
+        for key in sorted(uniforms):
+            if shader.hasUniform(key):
+                value = uniforms[key]
+                if isinstance(value, euclid.Matrix4):
+                    value = tuple(value[:])
+                elif not isinstance(value, (int, float)):
+                    value = tuple(value)
+                values.append((key, value))
+        return tuple(values)
+
     def setUniforms(self, shader, uniforms):
         for key, value in uniforms.items():
             if isinstance(value, (int, float)):
@@ -99,9 +225,23 @@ class BaseRenderer(object):
     def free(self):
         raise NotImplementedError("Must be implemented")
 
+    def invalidate(self):
+        #Called after the OpenGL context was lost. Forgets all OpenGL
+        #handles but keeps the CPU side data needed to restore them.
+        raise NotImplementedError("Must be implemented")
+
+    def restore(self):
+        #Recreates the OpenGL objects after invalidate()
+        raise NotImplementedError("Must be implemented")
+
     def getSize(self):
         raise NotImplementedError("Must be implemented")
 
+    def getFingerprint(self, context):
+        #Anything hashable that changes when the rendered image would change.
+        #None disables frame caching.
+        return None
+
     def render(self, context):
         raise NotImplementedError("Must be implemented")
 
@@ -130,10 +270,21 @@ class Renderer2D(BaseRenderer):
             self.shader.free()
             self.shader = None
 
+    def invalidate(self):
+        self.shader.invalidate()
+        self.textureMap.invalidate()
+
+    def restore(self):
+        self.shader.restore()
+        self.textureMap.restore()
+
     def getSize(self):
         tex = self.textureMap.textures[shader.TEX0]
         return tex.width, tex.height
 
+    def getFingerprint(self, context):
+        return (self.textureMap.getGenerations(), self.getUniformFingerprint(self.shader, context.uniforms))
+
     def createVertexQuad(self):
         tx2 = 1.0 #Adjust if rounding textures to power of two
         ty2 = 1.0
@@ -210,6 +361,16 @@ class Renderer3D(BaseRenderer):
             entry.free()
         self.models.clear()
 
+    def invalidate(self):
+        self.shader.invalidate()
+        for entry in self.models.values():
+            entry.textureMap.invalidate()
+
+    def restore(self):
+        self.shader.restore()
+        for entry in self.models.values():
+            entry.textureMap.restore()
+
     def getModel(self, tag):
         return self.models.get(tag)
 
@@ -234,11 +395,19 @@ class Renderer3D(BaseRenderer):
     def getSize(self):
         return self.width, self.height
 
+    def getFingerprint(self, context):
+        models = []
+        for tag in sorted(self.models):
+            entry = self.models[tag]
+            models.append((tag, id(entry.mesh), tuple(entry.matrix[:]), entry.textureMap.getGenerations()))
+        return (tuple(models), self.getUniformFingerprint(self.shader, context.uniforms))
+
     def render(self, context):
         self.shader.bind()
 
-        gl.glDisable(gl.GL_BLEND)
-        gl.glEnable(gl.GL_DEPTH_TEST)
+        state = glstate.tracker
+        state.disable(gl.GL_BLEND)
+        state.enable(gl.GL_DEPTH_TEST)
 
         gl.glClearDepth(1.0)
         gl.glClearColor(*self.clearColor)
@@ -267,22 +436,174 @@ class Renderer3D(BaseRenderer):
 
             entry.textureMap.unbindTextures()
 
-        gl.glEnable(gl.GL_BLEND)
-        gl.glDisable(gl.GL_DEPTH_TEST)
+        state.enable(gl.GL_BLEND)
+        state.disable(gl.GL_DEPTH_TEST)
 
         self.shader.unbind()
 
-class BoneTransform:
-    def __init__(self, bone, matrix, damping, transparency):
+class BoneTransform(object):
+    __slots__ = ("bone", "_matrix", "damping", "transparency", "index", "world", "offset")
+
+    def __init__(self, bone, matrix, damping, transparency, world=None, offset=0):
+        #Either a matrix or the world matrix array of a BoneHierarchy and the offset in it
         self.bone = bone
-        self.matrix = matrix
+        self._matrix = matrix
         self.damping = damping
         self.transparency = transparency
+        self.index = -1 #Set when vertex weights are computed
+        self.world = world
+        self.offset = offset
+
+    @property
+    def matrix(self):
+        #Created only when needed, most bones go from the array straight into the palette
+        if self._matrix is None:
+            self._matrix = hierarchy.toMatrix4(self.world, self.offset)
+        return self._matrix
+
+    @matrix.setter
+    def matrix(self, matrix):
+        self._matrix = matrix
+
+class BonePalette:
+    #Bone matrices for the skinning shader. Either full column-major 4x4 matrices
+    #or, if affine, two vec4 rows of a 2D affine matrix per bone (see VS_SKINNED_2D).
+
+    def __init__(self, size):
+        self.size = size
+        self.count = 0
+        self.affine = False
+        self.stride = 16
+        self.data = (gl.GLfloat * (size * 16))()
+
+    def setAffine(self, affine):
+        self.affine = affine
+        self.stride = 8 if affine else 16
+
+    def setWorld(self, index, world, offset, transparency, x=0.0, y=0.0):
+        #Writes a matrix of a BoneHierarchy in place, x and y are added to the
+        #translation. The 4x4 layout is column-major like utils.matrixToList()
+        #with the transparency in the unused last element.
+        a, b, c, d, e, f, g, h, i, j, k, l = world[offset:offset + hierarchy.MATRIX_SIZE]
+        d += x
+        h += y
+        if self.affine:
+            start = index * 8
+            self.data[start:start + 8] = (a, b, d, transparency, e, f, h, 0.0)
+        else:
+            start = index * 16
+            self.data[start:start + 16] = (a, e, i, 0.0, b, f, j, 0.0, c, g, k, 0.0, d, h, l, transparency)
+
+    def getBytes(self):
+        return ctypes.string_at(self.data, self.count * self.stride * ctypes.sizeof(gl.GLfloat))
+
+    def upload(self, shader):
+        if self.affine:
+            shader.uniform4fv("boneAffine", self.data, self.count * 2)
+        else:
+            shader.uniformMatrix4fv("boneMatrices", self.data, self.count)
+
+class RigTemplate:
+    #Rig data shared by all renderers using the same rig file: bones with their
+    #meshes and images, and the textures. Every renderer poses its own bone instances.
+
+    def __init__(self, image, path, deferred=True):
+        loader = SkinnedRenderer()
+        loader.skinTextures.deferred = deferred
+        loader.loadRig(image, path)
+
+        self.key = None
+        self.bones = loader.bones
+        self.rootName = loader.root.name
+        self.size = loader.size
+        self.atlas = loader.atlas
+        self.textures = loader.skinTextures
+        self.shared = False #Set if from RigTemplateCache, which frees it
+        self.refs = 0 #Renderers using this, counted by RigTemplateCache
+        self.uploaded = False
+        self.modeChangeCount = 0
+
+    def createBones(self):
+        bones = {}
+        for name, bone in self.bones.items():
+            bones[name] = bone.createInstance()
+        return bones
+
+    def upload(self):
+        #Called by every renderer using this when it is initialized
+        if not self.uploaded:
+            self.uploaded = True
+            self.modeChangeCount = shader.getModeChangeCount()
+        self.textures.deferred = False
+        self.textures.uploadPending()
+
+    def restoreTextures(self):
+        #Called by every renderer using this after a context loss, only the first one restores
+        count = shader.getModeChangeCount()
+        if self.modeChangeCount != count:
+            self.modeChangeCount = count
+            self.textures.invalidate()
+            self.textures.restore()
+
+class RigTemplateCache:
+    #Every get() must be matched by a release(), templates are dropped from
+    #the cache as soon as no renderer uses them.
+
+    def __init__(self):
+        self.templates = {}
+        self.loading = {} #Events of rigs being loaded
+        self.lock = threading.Lock()
+
+    def get(self, image, path, deferred=True):
+        #Can be called from a background thread if the texture uploads are deferred.
+        #The rig is loaded outside of the lock, callers that want the same rig
+        #while it is loading wait for it.
+        key = (path, utils.getFileTime(skin.findRigFile(path)))
+        while True:
+            with self.lock:
+                template = self.templates.get(key)
+                if template:
+                    template.refs += 1
+                    return template
+                loading = self.loading.get(key)
+                if not loading:
+                    loading = threading.Event()
+                    self.loading[key] = loading
+                    break
+            #Loaded again if the other load fails
+            loading.wait()
+
+        try:
+            template = RigTemplate(image, path, deferred)
+            with self.lock:
+                #Older versions of an edited rig are not found again, their
+                #renderers release them when they are freed
+                for old in [k for k in self.templates if k[0] == path]:
+                    del self.templates[old]
+
+                template.key = key
+                template.shared = True
+                template.refs = 1
+                self.templates[key] = template
+            return template
+        finally:
+            with self.lock:
+                del self.loading[key]
+            loading.set()
+
+    def release(self, template):
+        with self.lock:
+            template.refs -= 1
+            if template.refs > 0:
+                return
+            if self.templates.get(template.key) is template:
+                del self.templates[template.key]
+        template.textures.free()
+
+    def clear(self):
+        with self.lock:
+            self.templates.clear()
 
-class SkinnedFrameData:
-    def __init__(self, time, transform):
-        self.time = time
-        self.transform = transform
 
 class SkinnedRenderer(BaseRenderer):
     BLACK_TEXTURE = "__black"
@@ -294,21 +615,53 @@ class SkinnedRenderer(BaseRenderer):
         self.size = None
         self.root = None
         self.bones = {}
-        self.oldFrameData = {}
+        self.springs = dynamics.SpringSolver()
+        self.palette = BonePalette(skin.MAX_BONES)
+        self.hierarchy = hierarchy.BoneHierarchy()
+        self.poseVersion = 0 #Increased whenever the bone transforms change
+        self.poseOrder = None
+        self.poseTransforms = None
+        self.poseTransformMap = None
+        self.frameTransforms = None
+        self.geometryVersion = 0
         self.pointResolution = 30
         self.gridResolution = 0
+        self.prepared = False
+        self.atlas = None
+        self.template = None
 
     def getBones(self):
         return self.bones
 
     def init(self, image, vertexShader, pixeShader, args):
+        if not self.prepared:
+            #Textures are uploaded while the rest of the images are still loading
+            self.prepare(image, args, False)
+
         self.shader = utils.Shader(vertexShader.replace("MAX_BONES", str(skin.MAX_BONES)), pixeShader)
+        #Shaders like VS_SKINNED_2D take half the palette
+        self.palette.setAffine(self.shader.hasUniform("boneAffine"))
+        if self.template:
+            self.template.upload()
+        else:
+            self.skinTextures.deferred = False
+            self.skinTextures.uploadPending()
+
+    def prepare(self, image, args, deferred=True):
+        #Everything that doesn't need OpenGL: loading the rig, decoding and cropping
+        #images, triangulation and weights. Safe to run in a background thread
+        #if the texture uploads are deferred.
+        self.skinTextures.deferred = deferred
         self.pointResolution = args.get("pointResolution", self.pointResolution)
         self.gridResolution = args.get("gridResolution", self.gridResolution)
 
         rig = args.get("rigFile")
         if rig:
-            self.loadJson(image, rig)
+            if args.get("sharedRig", True):
+                self.useTemplate(shader._rigTemplates.get(image, rig, deferred))
+            else:
+                #Editing changes meshes and images, so those can't be shared
+                self.useTemplate(RigTemplate(image, rig, deferred))
         else:
             if self.isLiveComposite(image):
                 self.loadLiveComposite(image)
@@ -317,14 +670,41 @@ class SkinnedRenderer(BaseRenderer):
 
             self.updateMeshes()
             self.updateBones()
+            self.updateUvs()
+            self.loadInfluenceImages()
+
+        self.prepared = True
+
+    def loadRig(self, image, path):
+        self.loadJson(image, path)
+        self.updateUvs()
+        self.loadInfluenceImages()
+
+    def useTemplate(self, template):
+        self.template = template
+        self.bones = template.createBones()
+        self.root = self.bones[template.rootName]
+        self.size = template.size
+        self.atlas = template.atlas
+        self.skinTextures = template.textures
 
+    def updateUvs(self):
         for bone in self.bones.values():
-            if bone.mesh:
+            if bone.mesh and bone.mesh.isLoaded() and not bone.mesh.uvs:
                 bone.mesh.updateUvs(bone)
 
-        self.loadInfluenceImages()
+    def getResidentBytes(self):
+        #Memory used by the decoded meshes and the textures. Meshes of lazily
+        #loaded rigs only count after they have been drawn or edited.
+        meshes = dict((id(bone.mesh), bone.mesh) for bone in self.bones.values() if bone.mesh)
+        total = sum([mesh.getResidentBytes() for mesh in meshes.values()])
+        for entry in self.skinTextures.textures.values():
+            if entry.glTexture or entry.pending:
+                total += entry.width * entry.height * 4
+        return total
 
     def updateMeshes(self, autoSubdivide=False, sizeSubdivide=0):
+        self.geometryVersion += 1
         transforms = self.computeBoneTransforms()
         for transform in transforms:
             bone = transform.bone
@@ -339,7 +719,8 @@ class SkinnedRenderer(BaseRenderer):
                 bone.mesh.weldVertices()
 
     def updateBones(self):
-        self.oldFrameData = {}
+        self.geometryVersion += 1
+        self.springs.reset()
 
         transforms = self.computeBoneTransforms()
         for i, transform in enumerate(transforms):
@@ -350,17 +731,33 @@ class SkinnedRenderer(BaseRenderer):
                 bone.mesh.updateUvs(bone)
 
     def loadJson(self, image, path):
-        self.bones, data = skin.loadFromFile(path)
+        self.bones, data = skin.loadFromFile(path, shader.config.lazyMeshes)
         self.size = data["width"], data["height"]
 
+        #Compiled rigs have all bone images cropped and packed into one image
+        self.atlas = data.get("atlas")
+        atlasSurface = None
+        if self.atlas:
+            atlasSurface = self.loadSurface(self.atlas["image"])
+
         for name, bone in self.bones.items():
             if not bone.parent:
                 self.root = bone
 
-            if bone.image:
-                surface = self.loadCroppedSurface(bone, bone.image.name)
+        imageBones = [bone for bone in self.bones.values() if bone.image]
+        if atlasSurface:
+            for bone in imageBones:
+                surface = atlasSurface.subsurface(tuple(self.atlas["rects"][bone.name]))
+                self.skinTextures.setTexture(bone.image.name, surface)
+        else:
+            #Decode and crop in parallel, upload each one as soon as it is ready
+            loadFunc = lambda bone: self.loadCroppedSurface(bone, bone.image.name)
+            for bone, surface in tasks.pool.imapUnordered(loadFunc, imageBones):
                 self.skinTextures.setTexture(bone.image.name, surface)
 
+    def loadSurface(self, name):
+        return shader._surfaceCache.get(name)
+
     def isLiveComposite(self, image):
         #TODO There must be a better way to get this...
         container = image.visit()[0]
@@ -371,25 +768,40 @@ class SkinnedRenderer(BaseRenderer):
         self.size = container.style.xmaximum, container.style.ymaximum
         self.root = self.createRootBone()
 
+        def loadPart(child):
+            return self.loadImagePart(self.loadSurface(child.children[0].filename))
+
+        parts = {}
+        for child, part in tasks.pool.imapUnordered(loadPart, container.children):
+            self.skinTextures.setTexture(child.children[0].filename, part[0])
+            parts[child] = part
+
+        #Bones are created in order, the index is the z-order
         for i, child in enumerate(container.children):
-            placement = child.get_placement()
             base = child.children[0]
             boneName = base.filename.rsplit(".")[0]
-            surface = renpy.display.im.load_surface(base)
-            self.createImageBone(surface, boneName, base.filename, placement, i)
+            self.createImageBone(parts[child], boneName, base.filename, child.get_placement(), i)
 
     def loadNormalImage(self, image):
         surface = renpy.display.im.load_surface(image)
         self.size = surface.get_size()
         self.root = self.createRootBone()
         name = " ".join(image.name)
-        self.createImageBone(surface, name, name, (0, 0), 0)
+        part = self.loadImagePart(surface)
+        self.skinTextures.setTexture(name, part[0])
+        self.createImageBone(part, name, name, (0, 0), 0)
 
-    def createImageBone(self, surface, boneName, fileName, placement, zOrder):
-        originalWidth, originalHeight = surface.get_size()
+    def loadImagePart(self, surface):
+        #The slow part of creating an image bone, safe to run in a thread
+        originalSize = surface.get_size()
         crop = surface.get_bounding_rect()
         crop.inflate_ip(10, 10) #TODO For testing
-        surface = self.cropSurface(surface, crop)
+        cropped = self.getCroppedSurface(surface, crop)
+        points = skin.findEdgePoints(cropped, self.pointResolution)
+        return cropped, crop, originalSize, points
+
+    def createImageBone(self, part, boneName, fileName, placement, zOrder):
+        surface, crop, (originalWidth, originalHeight), points = part
         x = placement[0] + crop[0]
         y = placement[1] + crop[1]
 
@@ -401,13 +813,11 @@ class SkinnedRenderer(BaseRenderer):
         bone.pos = (x, y)
         bone.pivot = (bone.pos[0] + bone.image.width / 2.0, bone.pos[1] + bone.image.height / 2.0)
         bone.zOrder = zOrder
-        bone.updatePoints(surface, self.pointResolution)
+        bone.points = points
 
         self.bones[bone.parent].children.append(boneName)
         self.bones[boneName] = bone
 
-        self.skinTextures.setTexture(bone.image.name, surface)
-
     def createRootBone(self):
         root = skin.SkinningBone("root")
         root.pivot = (self.size[0] * 0.5, self.size[1] * 0.75)
@@ -419,24 +829,47 @@ class SkinnedRenderer(BaseRenderer):
         cropped.blit(surface, (0, 0), rect)
         return cropped
 
+    def getCroppedSurface(self, surface, rect):
+        #A view into the source if the crop covers most of it. Otherwise a copy,
+        #a view would keep the whole source alive after SurfaceCache drops it.
+        rect = tuple(rect)
+        width, height = surface.get_size()
+        inside = rect[0] >= 0 and rect[1] >= 0 and rect[0] + rect[2] <= width and rect[1] + rect[3] <= height
+        if inside and rect[2] * rect[3] >= width * height * SUBSURFACE_MIN_AREA:
+            return surface.subsurface(rect)
+        return self.cropSurface(surface, rect)
+
     def loadCroppedSurface(self, bone, name, resize=None):
-        surface = renpy.display.im.load_surface(renpy.exports.displayable(name))
+        surface = self.loadSurface(name)
         image = bone.image
         scale = 1
         if resize:
             scale = surface.get_width() / float(resize.originalWidth)
         crop = tuple(int(round(x)) for x in (image.x * scale, image.y * scale, image.width * scale, image.height * scale))
-        return self.cropSurface(surface, crop)
+        return self.getCroppedSurface(surface, crop)
 
     def loadInfluenceImages(self):
         self.skinTextures.setTexture(self.BLACK_TEXTURE, shader.ZERO_INFLUENCE)
 
-        for name, bone in self.bones.items():
-            if bone.image:
-                influence = self.getInfluenceName(bone.image.name)
-                if renpy.exports.has_image(influence, exact=True):
-                    surface = self.loadCroppedSurface(bone, influence, bone.image)
-                    self.skinTextures.setTexture(influence, surface)
+        if self.atlas:
+            if self.atlas["influence"]:
+                atlasSurface = self.loadSurface(self.atlas["influenceImage"])
+                for name in self.atlas["influence"]:
+                    bone = self.bones[name]
+                    surface = atlasSurface.subsurface(tuple(self.atlas["rects"][name]))
+                    self.skinTextures.setTexture(self.getInfluenceName(bone.image.name), surface)
+            return
+
+        def loadInfluence(bone):
+            influence = self.getInfluenceName(bone.image.name)
+            if renpy.exports.has_image(influence, exact=True):
+                return influence, self.loadCroppedSurface(bone, influence, bone.image)
+            return None
+
+        imageBones = [bone for bone in self.bones.values() if bone.image]
+        for bone, result in tasks.pool.imapUnordered(loadInfluence, imageBones):
+            if result:
+                self.skinTextures.setTexture(*result)
 
     def getInfluenceName(self, name):
         return name.split(".")[0] + " influence"
@@ -446,13 +879,31 @@ class SkinnedRenderer(BaseRenderer):
 
     def free(self):
         if self.skinTextures:
-            self.skinTextures.free()
+            if self.template and self.template.shared:
+                shader._rigTemplates.release(self.template)
+            else:
+                self.skinTextures.free()
+            self.template = None
             self.skinTextures = None
 
         if self.shader:
             self.shader.free()
             self.shader = None
 
+    def invalidate(self):
+        #Bones, meshes, weights and the cropped surfaces stay in memory,
+        #only the program and textures have to be created again.
+        self.shader.invalidate()
+        if not self.template:
+            self.skinTextures.invalidate()
+
+    def restore(self):
+        self.shader.restore()
+        if self.template:
+            self.template.restoreTextures()
+        else:
+            self.skinTextures.restore()
+
     def getSize(self):
         return self.size
 
@@ -465,7 +916,40 @@ class SkinnedRenderer(BaseRenderer):
             setattr(result, attr, projection[i])
         return result
 
+    def prepareFrame(self, context):
+        #Evaluates the pose into the bone palette. Called once per frame, either
+        #by getFingerprint() or by render().
+        transforms = self.computeBoneTransforms()
+
+        #Damped bones are moved by the secondary motion simulation
+        offsets = self.springs.update(transforms, context.shownTime)
+
+        palette = self.palette
+        palette.count = len(transforms)
+        for i, transform in enumerate(transforms):
+            offset = offsets[i]
+            if offset:
+                palette.setWorld(i, transform.world, transform.offset, transform.transparency, offset[0], offset[1])
+            else:
+                palette.setWorld(i, transform.world, transform.offset, transform.transparency)
+
+        self.frameTransforms = transforms
+
+    def getFingerprint(self, context):
+        self.prepareFrame(context)
+
+        palette = self.palette
+        bones = tuple((t.bone.visible, t.bone.wireFrame) for t in self.frameTransforms)
+        return (palette.getBytes(),
+            bones, self.geometryVersion, self.skinTextures.getGenerations(),
+            self.getUniformFingerprint(self.shader, context.uniforms))
+
     def render(self, context):
+        if self.frameTransforms is None:
+            self.prepareFrame(context)
+        transforms = self.frameTransforms
+        self.frameTransforms = None
+
         self.shader.bind()
 
         self.setUniforms(self.shader, context.uniforms)
@@ -473,64 +957,20 @@ class SkinnedRenderer(BaseRenderer):
 
         gl.glClearColor(*self.clearColor)
         gl.glClear(gl.GL_COLOR_BUFFER_BIT)
-        gl.glDisable(gl.GL_DEPTH_TEST)
+        glstate.tracker.disable(gl.GL_DEPTH_TEST)
 
-        transforms = self.computeBoneTransforms()
-
-        boneMatrixArray = []
-        for i, transform in enumerate(transforms):
-            boneMatrix = transform.matrix
-            boneMatrix.p = transform.transparency #Abuse unused matrix location
-
-            overwrite = transform.damping > 0.0
-            if overwrite and self.oldFrameData.get(transform.bone.name):
-                overwrite = self.dampenBoneTransform(context, transform)
-
-            if overwrite:
-                self.oldFrameData[transform.bone.name] = SkinnedFrameData(context.shownTime, transform)
-
-            boneMatrixArray.extend(utils.matrixToList(boneMatrix))
-        self.shader.uniformMatrix4fArray("boneMatrices", boneMatrixArray)
+        self.palette.upload(self.shader)
 
         for transform in transforms:
             self.renderBoneTransform(transform, context)
 
         for i in range(2):
-            gl.glActiveTexture(gl.GL_TEXTURE0 + i)
-            gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+            glstate.tracker.bindTexture(i, 0)
 
-        gl.glActiveTexture(gl.GL_TEXTURE0)
+        glstate.tracker.activeTexture(0)
 
         self.shader.unbind()
 
-    def dampenBoneTransform(self, context, transform):
-        data = self.oldFrameData[transform.bone.name]
-        old = data.transform.matrix
-
-        #Abuse unused matrix locations
-        boneMatrix = transform.matrix
-        boneMatrix.m = 0
-        boneMatrix.n = 0
-        boneMatrix.o = 0
-        old.m = 0
-        old.n = 0
-        old.o = 0
-
-        pivot = transform.bone.pivot
-        v = euclid.Vector3(pivot[0], pivot[1], 0.0)
-        pos = boneMatrix.transform(v)
-        posOld = old.transform(v)
-
-        deltaX = posOld.x - pos.x
-        deltaY = posOld.y - pos.y
-        dampness = max(transform.damping - max(float(context.shownTime) - data.time, 0.0), 0.0)
-
-        boneMatrix.m = deltaX
-        boneMatrix.n = deltaY
-        boneMatrix.o = dampness
-
-        return dampness <= 0.0
-
     def renderBoneTransform(self, transform, context):
         bone = transform.bone
         mesh = bone.mesh
@@ -549,12 +989,10 @@ class SkinnedRenderer(BaseRenderer):
             texInfluence = self.skinTextures.textures[self.BLACK_TEXTURE]
 
         self.shader.uniformi(shader.TEX0, 0)
-        gl.glActiveTexture(gl.GL_TEXTURE0 + 0)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, tex.glTexture)
+        glstate.tracker.bindTexture(0, tex.glTexture)
 
         self.shader.uniformi(shader.TEX1, 1)
-        gl.glActiveTexture(gl.GL_TEXTURE0 + 1)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, texInfluence.glTexture)
+        glstate.tracker.bindTexture(1, texInfluence.glTexture)
 
         self.shader.uniformMatrix4f(shader.PROJECTION, self.getProjection())
 
@@ -580,51 +1018,34 @@ class SkinnedRenderer(BaseRenderer):
         self.unbindAttributeArray(self.shader, "inBoneIndices")
 
     def computeBoneTransforms(self):
-        transforms = []
-        stack = []
-        stack.append((None, euclid.Matrix4(), 0.0, 0.0))
-        self.computeBoneTransformRecursive(self.root, transforms, stack)
-        stack.pop()
-        transforms.sort(key=lambda t: t.bone.zOrder)
-
-        if len(stack) != 0:
-            raise RuntimeError("Unbalanced stack size: %i" % len(stack))
-
-        if len(transforms) > skin.MAX_BONES:
-            raise RuntimeError("Too many bones, maximum is %i" % skin.MAX_BONES)
-
-        return transforms
-
-    def computeBoneTransformRecursive(self, bone, transforms, stack):
-        parent, parentMatrix, parentDamping, parentTransparency = stack[-1]
-
-        transform = euclid.Matrix4() * parentMatrix
-
-        pivot = bone.pivot
-        xMove = pivot[0]
-        yMove = pivot[1]
-
-        transform.translate(xMove, yMove, 0)
-        transform.translate(bone.translation.x, bone.translation.y, 0)
-
-        rotation = bone.rotation
-        if rotation.y != 0.0:
-            transform.rotatey(rotation.y)
-        if rotation.x != 0.0:
-            transform.rotatex(rotation.x)
-        if rotation.z != 0.0:
-            transform.rotatez(rotation.z)
-
-        transform.scale(bone.scale.x, bone.scale.y, bone.scale.z)
-
-        transform.translate(-xMove, -yMove, 0)
-
-        damping = max(bone.damping, parentDamping)
-        transparency = 1 - ((1 - bone.transparency) * (1 - parentTransparency))
-        transforms.append(BoneTransform(bone, transform, damping, transparency))
-        stack.append((bone, transform, damping, transparency))
-
-        for childName in bone.children:
-            self.computeBoneTransformRecursive(self.bones[childName], transforms, stack)
-
-        stack.pop()
+        #Transforms sorted by z-order. The same list is returned until the pose
+        #changes, so don't modify it or the matrices in it.
+        bones = self.hierarchy
+        bones.update(self.bones, self.root)
+        world = bones.evaluate()
+
+        order = tuple([bone.zOrder for bone in bones.bones])
+        if bones.recomputed or order != self.poseOrder or self.poseTransforms is None:
+            transforms = []
+            damping = bones.damping
+            transparency = bones.transparency
+            for index, bone in enumerate(bones.bones):
+                transforms.append(BoneTransform(bone, None, damping[index], transparency[index], world, index * hierarchy.MATRIX_SIZE))
+            transforms.sort(key=lambda t: t.bone.zOrder)
+
+            if len(transforms) > skin.MAX_BONES:
+                raise RuntimeError("Too many bones, maximum is %i" % skin.MAX_BONES)
+
+            self.poseVersion += 1
+            self.poseOrder = order
+            self.poseTransforms = transforms
+            self.poseTransformMap = None
+
+        return self.poseTransforms
+
+    def getTransformMap(self):
+        #Transforms of computeBoneTransforms() by bone name
+        transforms = self.computeBoneTransforms()
+        if self.poseTransformMap is None:
+            self.poseTransformMap = dict((t.bone.name, t) for t in transforms)
+        return self.poseTransformMap
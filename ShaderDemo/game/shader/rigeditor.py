@@ -375,7 +375,7 @@ class RigEditor:
         self.settings = settings
         self.mouse = (0, 0)
         self.transforms = context.renderer.computeBoneTransforms()
-        self.transformsMap = self.getTransformsDict()
+        self.transformsMap = context.renderer.getTransformMap()
 
         self.mode = self.get(MODE)
         if not self.mode:
@@ -694,12 +694,6 @@ class RigEditor:
         pivot = bone.pivot
         return euclid.Vector3(pivot[0],  pivot[1], 0)
 
-    def getTransformsDict(self):
-        mapping = {}
-        for trans in self.transforms:
-            mapping[trans.bone.name] = trans
-        return mapping
-
     def visualizeBones(self):
         context = self.context
         canvas = context.overlayCanvas
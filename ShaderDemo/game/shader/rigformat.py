@@ -0,0 +1,186 @@
+
+#Binary rig file format. Has no dependencies outside the standard library,
+#so the command line tools can use it without Ren'Py or OpenGL.
+#
+#Layout:
+#   magic (4 bytes), version (uint32), header size (uint32)
+#   header: UTF-8 JSON, the same data as in a .rig file but meshes only describe their arrays
+#   data: mesh arrays as little-endian float32 or uint32, each aligned to ALIGN bytes
+#
+#Array descriptors in the header are {"type": "f" or "I", "offset": bytes from
+#the start of the data section, "count": number of elements}.
+
+import sys
+import json
+import base64
+import mmap
+import array
+import ctypes
+import struct
+import functools
+
+import jsonwriter
+
+MAGIC = b"RIGB"
+VERSION = 1
+EXTENSION = ".rigb"
+ALIGN = 16
+
+HEADER = struct.Struct("<4sII")
+
+MESH_ARRAYS = {
+    "vertices": "f",
+    "indices": "I",
+    "boneWeights": "f",
+    "boneIndices": "f",
+    "uvs": "f", #Only in compiled rigs
+}
+
+CTYPES = {
+    "f": ctypes.c_float,
+    "I": ctypes.c_uint32,
+}
+
+NATIVE = sys.byteorder == "little"
+
+def align(size):
+    return (size + ALIGN - 1) // ALIGN * ALIGN
+
+def toBytes(values):
+    if not NATIVE:
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    if hasattr(values, "tobytes"):
+        return values.tobytes()
+    return values.tostring()
+
+def encodeArray(tp, values):
+    if isinstance(values, ctypes.Array) and NATIVE:
+        return ctypes.string_at(values, ctypes.sizeof(values))
+    return toBytes(array.array(tp, values))
+
+def getTypeCode(values):
+    for tp, ctype in CTYPES.items():
+        if values._type_ is ctype:
+            return tp
+    return None
+
+def packArray(values):
+    #A ctypes array as base64 for JSON files, None if the type is not supported
+    tp = getTypeCode(values)
+    if tp is None:
+        return None
+    return {"type": tp, "base64": base64.b64encode(encodeArray(tp, values)).decode("ascii")}
+
+def unpackArray(data):
+    raw = bytearray(base64.b64decode(data["base64"]))
+    tp = data["type"]
+    count = len(raw) // ctypes.sizeof(CTYPES[tp])
+    return getArray(raw, 0, {"type": tp, "offset": 0, "count": count})
+
+def isPacked(values):
+    return isinstance(values, dict) and "base64" in values
+
+def save(data, path):
+    #Writes a rig, as loaded from a .rig file or by load(), into a binary file
+    header = dict(data)
+    header["bones"] = {}
+    blobs = []
+    offset = 0
+
+    for name, bone in data["bones"].items():
+        bone = dict(bone)
+        mesh = bone.get("mesh")
+        if mesh:
+            mesh = dict(mesh)
+            for key, tp in MESH_ARRAYS.items():
+                values = mesh.get(key)
+                if values is None:
+                    continue
+                blob = encodeArray(tp, values)
+                mesh[key] = {"type": tp, "offset": offset, "count": len(values)}
+                blobs.append((offset, blob))
+                offset = align(offset + len(blob))
+            bone["mesh"] = mesh
+        header["bones"][name] = bone
+
+    headerData = json.dumps(header, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    dataStart = align(HEADER.size + len(headerData))
+
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(headerData)))
+        f.write(headerData)
+        f.write(b"\0" * (dataStart - HEADER.size - len(headerData)))
+        position = 0
+        for blobOffset, blob in blobs:
+            f.write(b"\0" * (blobOffset - position))
+            f.write(blob)
+            position = blobOffset + len(blob)
+
+def load(path, lazy=False):
+    #Maps the file into memory. Arrays point straight into the mapping and
+    #are copy-on-write, so changing them never modifies the file.
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    return loadFromBuffer(buffer, lazy)
+
+def loadFromBuffer(buffer, lazy=False):
+    #Buffer must be writable, like a bytearray or a copy-on-write mmap. If lazy,
+    #mesh arrays are functions that return the array when called.
+    magic, version, headerSize = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise RuntimeError("Not a binary rig file")
+    if version != VERSION:
+        raise RuntimeError("Incompatible binary rig version, should be %i" % VERSION)
+
+    header = json.loads(bytes(buffer[HEADER.size:HEADER.size + headerSize]).decode("utf-8"))
+    dataStart = align(HEADER.size + headerSize)
+
+    for bone in header["bones"].values():
+        mesh = bone.get("mesh")
+        if mesh:
+            for key in MESH_ARRAYS:
+                info = mesh.get(key)
+                if info is None:
+                    continue
+                if lazy:
+                    mesh[key] = functools.partial(getArray, buffer, dataStart, info)
+                else:
+                    mesh[key] = getArray(buffer, dataStart, info)
+    return header
+
+def getArray(buffer, dataStart, info):
+    tp = CTYPES[info["type"]]
+    offset = dataStart + info["offset"]
+    count = info["count"]
+    if NATIVE:
+        return (tp * count).from_buffer(buffer, offset)
+
+    values = array.array(info["type"])
+    raw = bytes(buffer[offset:offset + count * ctypes.sizeof(tp)])
+    if hasattr(values, "frombytes"):
+        values.frombytes(raw)
+    else:
+        values.fromstring(raw)
+    values.byteswap()
+    return (tp * count)(*values)
+
+def saveJson(data, path, packArrays=False):
+    #Same formatting as skin.saveToFile()
+    jsonwriter.save(data, path, packArray=packArray if packArrays else None)
+
+def loadJson(path):
+    #Base64 packed mesh arrays are unpacked
+    with open(path, "r") as f:
+        data = json.load(f)
+
+    for bone in data["bones"].values():
+        mesh = bone.get("mesh")
+        if mesh:
+            for key in MESH_ARRAYS:
+                if isPacked(mesh.get(key)):
+                    mesh[key] = unpackArray(mesh[key])
+    return data
+
+def getBinaryPath(path):
+    return path.rsplit(".", 1)[0] + EXTENSION
@@ -0,0 +1,143 @@
+
+import time
+import collections
+
+import shader
+
+#Frames rendered during this many last seconds are used for the fps
+FPS_WINDOW = 1.0
+
+#Displayables that have not rendered for this long don't count towards the budget
+ACTIVE_TIMEOUT = 1.0
+
+#How often the frame budget is divided between displayables
+BALANCE_INTERVAL = 0.1
+
+#Throttling never slows a displayable down more than this
+MIN_THROTTLE = 0.1
+
+#Weight of the newest frame in the render time average
+AVERAGE_WEIGHT = 0.1
+
+class FrameStats:
+    def __init__(self, tag):
+        self.tag = tag
+        self.rate = shader.RATE_FULL
+        self.priority = 0
+        self.throttle = 1.0
+        self.frames = collections.deque()
+        self.frameCount = 0
+        self.cachedFrameCount = 0 #Frames that reused the previous image
+        self.renderTime = 0.0 #Average seconds spent in a frame
+        self.totalTime = 0.0
+        self.lastFrame = 0.0
+
+    def addFrame(self, now, elapsed):
+        if self.frameCount == 0:
+            self.renderTime = elapsed
+        else:
+            self.renderTime += (elapsed - self.renderTime) * AVERAGE_WEIGHT
+        self.frameCount += 1
+        self.totalTime += elapsed
+        self.lastFrame = now
+        self.frames.append(now)
+        self.expire(now)
+
+    def addCachedFrame(self, now):
+        #Costs next to nothing, so only keeps the displayable active
+        self.cachedFrameCount += 1
+        self.lastFrame = now
+
+    def expire(self, now):
+        while self.frames and self.frames[0] < now - FPS_WINDOW:
+            self.frames.popleft()
+
+    def getFps(self):
+        #Frames actually rendered during the last second
+        self.expire(time.time())
+        return len(self.frames) / FPS_WINDOW
+
+    def getTargetFps(self):
+        if self.rate == shader.RATE_FULL:
+            return shader.config.fps
+        elif self.rate == shader.RATE_AMBIENT:
+            return min(shader.config.ambientFps, shader.config.fps)
+        return 0
+
+    def getLoad(self):
+        #Seconds of rendering per displayed frame at the target rate
+        return self.renderTime * self.getTargetFps() / float(shader.config.fps)
+
+    def isActive(self, now):
+        return self.rate != shader.RATE_IDLE and now - self.lastFrame < ACTIVE_TIMEOUT
+
+
+class RedrawScheduler:
+    def __init__(self):
+        self.stats = {}
+        self.lastBalance = 0.0
+
+    def get(self, tag):
+        stats = self.stats.get(tag)
+        if not stats:
+            stats = FrameStats(tag)
+            self.stats[tag] = stats
+        return stats
+
+    def remove(self, tag):
+        if tag in self.stats:
+            del self.stats[tag]
+
+    def addFrame(self, tag, elapsed):
+        self.get(tag).addFrame(time.time(), elapsed)
+
+    def addCachedFrame(self, tag):
+        self.get(tag).addCachedFrame(time.time())
+
+    def getRedrawDelay(self, tag, rate, priority=0, unchangedFrames=0):
+        #Returns None if the displayable should not be redrawn until it gets new input
+        stats = self.get(tag)
+        stats.rate = rate
+        stats.priority = priority
+
+        now = time.time()
+        if now - self.lastBalance > BALANCE_INTERVAL:
+            self.balance(now)
+
+        targetFps = stats.getTargetFps()
+        if targetFps <= 0:
+            return None
+
+        frameTime = 1.0 / (targetFps * stats.throttle)
+        if unchangedFrames == 0:
+            return frameTime
+
+        #Back off exponentially while the image stays the same
+        delay = frameTime * (2 ** min(unchangedFrames, 10))
+        return min(delay, max(shader.config.idleRedrawDelay, frameTime))
+
+    def balance(self, now):
+        #Slow down the least important displayables until the total fits in the budget
+        self.lastBalance = now
+
+        active = [s for s in self.stats.values() if s.isActive(now)]
+        for stats in active:
+            stats.throttle = 1.0
+
+        excess = sum([s.getLoad() for s in active]) - shader.config.frameBudget
+        if excess <= 0:
+            return
+
+        active.sort(key=lambda s: s.priority)
+        for stats in active:
+            load = stats.getLoad()
+            if load <= 0:
+                continue
+            cut = min(excess, load * (1.0 - MIN_THROTTLE))
+            stats.throttle = 1.0 - cut / load
+            excess -= cut
+            if excess <= 0:
+                break
+
+    def getTotalTime(self):
+        return sum([s.totalTime for s in self.stats.values()])
@@ -251,10 +251,6 @@ void main()
         mat4 boneMatrix = boneMatrices[boneIndex.x];
         pos += (boneMatrix * vec4(inVertex, 0.0, 1.0) * boneWeights.x).xy;
 
-        //Apply damping
-        vec2 boneDelta = vec2(boneMatrix[0][3], boneMatrix[1][3]);
-        pos += (boneDelta * boneWeights.x) * boneMatrix[2][3];
-
         //Apply transparency
         transparency += boneMatrix[3][3] * boneWeights.x;
 
@@ -267,6 +263,57 @@ void main()
 }
 """
 
+VS_SKINNED_2D = """
+
+uniform mat4 projection;
+
+//Two rows of a 2D affine matrix per bone: (a, b, x, transparency) and (c, d, y, unused).
+//Damping is already added to the translation.
+uniform vec4 boneAffine[MAX_BONES * 2];
+
+uniform vec2 screenSize;
+uniform float shownTime;
+
+attribute vec2 inVertex;
+attribute vec2 inUv;
+attribute vec4 inBoneWeights;
+attribute vec4 inBoneIndices;
+
+varying vec2 varUv;
+varying float varAlpha;
+
+vec2 toScreen(vec2 point)
+{
+    return vec2(point.x / (screenSize.x / 2.0) - 1.0, point.y / (screenSize.y / 2.0) - 1.0);
+}
+
+void main()
+{
+    varUv = inUv;
+
+    vec3 vertex = vec3(inVertex, 1.0);
+    vec2 pos = vec2(0.0, 0.0);
+    float transparency = 0.0;
+    vec4 boneWeights = inBoneWeights;
+    ivec4 boneIndex = ivec4(inBoneIndices) * 2;
+
+    for (int i = 0; i < 4; i++) {
+        vec4 row0 = boneAffine[boneIndex.x];
+        vec4 row1 = boneAffine[boneIndex.x + 1];
+        pos += vec2(dot(row0.xyz, vertex), dot(row1.xyz, vertex)) * boneWeights.x;
+
+        //Apply transparency
+        transparency += row0.w * boneWeights.x;
+
+        boneWeights = boneWeights.yzwx;
+        boneIndex = boneIndex.yzwx;
+    }
+    varAlpha = max(1.0 - transparency, 0.0);
+
+    gl_Position = projection * vec4(toScreen(pos.xy), 0.0, 1.0);
+}
+"""
+
 PS_SKINNED = LIB_WIND + """
 
 varying vec2 varUv; //Texture coordinates
@@ -1,12 +1,16 @@
 
+import copy
 import ctypes
 import json
+import functools
 from OpenGL import GL as gl
 
 import euclid
 import geometry
 import delaunay
 import skinnedmesh
+import rigformat
+import jsonwriter
 import utils
 
 VERSION = 1
@@ -15,6 +19,11 @@ MAX_BONES = 64
 def makeArray(tp, values):
     return (tp * len(values))(*values)
 
+def findEdgePoints(surface, pointSimplify):
+    points = geometry.findEdgePixelsOrdered(surface)
+    simplified = geometry.simplifyEdgePixels(points, pointSimplify)
+    return geometry.offsetPolygon(simplified, -5) #TODO Increase this once better weighting is in?
+
 class SkinnedImage:
     jsonIgnore = []
 
@@ -27,8 +36,10 @@ class SkinnedImage:
         self.originalWidth = originalWidth
         self.originalHeight = originalHeight
 
-class SkinningBone:
-    jsonIgnore = ["wireFrame"]
+class SkinningBone(object):
+    __slots__ = ("name", "children", "parent", "image", "pos", "pivot", "translation", "rotation", "scale",
+        "zOrder", "visible", "wireFrame", "blocker", "tessellate", "transparency", "damping", "_points", "pointData", "source", "mesh")
+    jsonIgnore = ["wireFrame", "pointData", "source"]
 
     def __init__(self, name):
         self.name = name
@@ -47,9 +58,44 @@ class SkinningBone:
         self.tessellate = False
         self.transparency = 0.0
         self.damping = 0.0
-        self.points = []
+        self._points = []
+        self.pointData = None #Points of a lazily loaded bone, decoded the first time they are used
+        self.source = None #Bone this is an instance of, until its points are shared
         self.mesh = None
 
+    @property
+    def points(self):
+        if self.pointData is not None:
+            if self.source is not None:
+                #Decoded once by the bone all instances were created from
+                self._points = self.source.points
+            else:
+                self._points = [tuple(p) for p in self.pointData]
+            self.pointData = None
+            self.source = None
+        return self._points
+
+    @points.setter
+    def points(self, points):
+        self.pointData = None
+        self.source = None
+        self._points = points
+
+    def load(self):
+        #Decodes everything of a lazily loaded bone
+        self.points
+        if isinstance(self.mesh, skinnedmesh.LazyMesh):
+            self.mesh.load()
+
+    def createInstance(self):
+        #Shares the mesh, points, image and hierarchy, but has its own pose
+        bone = copy.copy(self)
+        bone.source = self if self.pointData is not None else None
+        bone.translation = self.translation.copy()
+        bone.rotation = self.rotation.copy()
+        bone.scale = self.scale.copy()
+        return bone
+
     def getAllChildren(self, bones, results=None):
         if not results:
             results = []
@@ -82,9 +128,7 @@ class SkinningBone:
                 parent.walkParents(bones, func, args)
 
     def updatePoints(self, surface, pointSimplify):
-        points = geometry.findEdgePixelsOrdered(surface)
-        simplified = geometry.simplifyEdgePixels(points, pointSimplify)
-        self.points = geometry.offsetPolygon(simplified, -5) #TODO Increase this once better weighting is in?
+        self.points = findEdgePoints(surface, pointSimplify)
 
     def triangulatePoints(self, gridResolution):
         points = self.points[:]
@@ -130,21 +174,17 @@ class SkinningBone:
 
 JSON_IGNORES = []
 
-class JsonEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, (SkinningBone, SkinnedImage, skinnedmesh.SkinnedMesh)):
-            d = obj.__dict__.copy()
-            for ignore in JSON_IGNORES + getattr(obj, "jsonIgnore", []):
-                if ignore in d:
-                    del d[ignore]
-            return d
-        elif isinstance(obj, euclid.Vector3):
-            return (obj.x, obj.y, obj.z)
-        elif isinstance(obj, ctypes.Array):
-            return list(obj)
-        return json.JSONEncoder.default(self, obj)
-
-def saveToFile(context, bones, path):
+def convertJson(obj):
+    if isinstance(obj, (SkinningBone, SkinnedImage, skinnedmesh.SkinnedMesh)):
+        if isinstance(obj, (SkinningBone, skinnedmesh.LazyMesh)):
+            obj.load()
+        return jsonwriter.getFields(obj, JSON_IGNORES + getattr(obj, "jsonIgnore", []))
+    elif isinstance(obj, euclid.Vector3):
+        return (obj.x, obj.y, obj.z)
+    raise TypeError("Can't write %r as JSON" % obj)
+
+def saveToFile(context, bones, path, packArrays=False):
+    #If packArrays is set, mesh arrays are written as base64
     size = context.renderer.getSize()
     data = {
         "version": VERSION,
@@ -153,19 +193,69 @@ def saveToFile(context, bones, path):
         "height": size[1],
     }
 
-    with open(path, "w") as f:
-        json.dump(data, f, indent=1, cls=JsonEncoder, separators=(",", ": "), sort_keys=True)
+    packArray = None
+    if packArrays:
+        packArray = rigformat.packArray
+    jsonwriter.save(data, path, convertJson, packArray)
 
 def _getArray(tp, obj, key):
     data = obj.get(key)
+    if callable(data):
+        #Not yet read from a lazily loaded binary rig
+        data = data()
+    elif rigformat.isPacked(data):
+        data = rigformat.unpackArray(data)
     if data:
+        if isinstance(data, ctypes.Array):
+            #Already an array from a binary rig
+            return data
         return makeArray(tp, data)
     return None
 
-def loadFromFile(path):
-    data = None
+def findRigFile(path):
+    #Prefers the binary version of a rig if it exists and is not older than the JSON one
+    binary = rigformat.getBinaryPath(path)
+    if binary == path or not utils.fileExists(binary):
+        return path
+    if not utils.fileExists(path):
+        return binary
+
+    binaryTime = utils.getFileTime(binary)
+    jsonTime = utils.getFileTime(path)
+    if binaryTime is None or jsonTime is None or binaryTime >= jsonTime:
+        #Archived files have no time, those are always built together
+        return binary
+    return path
+
+def loadRigData(path, lazy=False):
+    path = findRigFile(path)
+    if path.endswith(rigformat.EXTENSION):
+        realPath = utils.getRealPath(path)
+        if realPath:
+            return rigformat.load(realPath, lazy)
+        with utils.openFile(path) as f:
+            return rigformat.loadFromBuffer(bytearray(f.read()), lazy)
+
     with utils.openFile(path) as f:
-        data = json.load(f)
+        return json.load(f)
+
+def _getMeshArrays(mesh):
+    vertices = _getArray(gl.GLfloat, mesh, "vertices")
+    indices = _getArray(gl.GLuint, mesh, "indices")
+    boneWeights = _getArray(gl.GLfloat, mesh, "boneWeights")
+    boneIndices = _getArray(gl.GLfloat, mesh, "boneIndices")
+    uvs = _getArray(gl.GLfloat, mesh, "uvs") #Baked by the rig compiler
+    return vertices, indices, boneWeights, boneIndices, uvs
+
+def _createMesh(mesh):
+    vertices, indices, boneWeights, boneIndices, uvs = _getMeshArrays(mesh)
+    result = skinnedmesh.SkinnedMesh(vertices, indices, boneWeights, boneIndices)
+    result.uvs = uvs
+    return result
+
+def loadFromFile(path, lazy=False):
+    #If lazy, the points and meshes of bones are only decoded when first used
+    data = loadRigData(path, lazy)
 
     if data["version"] != VERSION:
         raise RuntimeError("Incompatible file format version, should be %i" % VERSION)
@@ -192,15 +282,16 @@ def loadFromFile(path):
         bone.tessellate = raw["tessellate"]
         bone.transparency = raw["transparency"]
         bone.damping = raw["damping"]
-        bone.points = [tuple(p) for p in raw["points"]]
 
         mesh = raw.get("mesh")
-        if mesh:
-            vertices = _getArray(gl.GLfloat, mesh, "vertices")
-            indices = _getArray(gl.GLuint, mesh, "indices")
-            boneWeights = _getArray(gl.GLfloat, mesh, "boneWeights")
-            boneIndices = _getArray(gl.GLfloat, mesh, "boneIndices")
-            bone.mesh = skinnedmesh.SkinnedMesh(vertices, indices, boneWeights, boneIndices)
+        if lazy:
+            bone.pointData = raw["points"]
+            if mesh:
+                bone.mesh = skinnedmesh.LazyMesh(functools.partial(_getMeshArrays, mesh), bone)
+        else:
+            bone.points = [tuple(p) for p in raw["points"]]
+            if mesh:
+                bone.mesh = _createMesh(mesh)
 
         bones[bone.name] = bone
 
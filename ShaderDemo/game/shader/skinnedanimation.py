@@ -4,12 +4,15 @@ import pygame
 
 import euclid
 import utils
+import jsonwriter
 import rigeditor
 import easing
 
 DEFAULT_EASING = "sineInOut"
 
-class KeyFrame:
+class KeyFrame(object):
+    __slots__ = ("translation", "rotation", "scale", "visible", "transparency")
+
     def __init__(self):
         #self.pivot = None #TODO Can affect weight calculations
         self.translation = None
@@ -51,7 +54,9 @@ def mixKeys(keys, weights):
         result.transparency = result.transparency + (key.transparency * weight)
     return result
 
-class Frame:
+class Frame(object):
+    __slots__ = ("keys",)
+
     def __init__(self):
         self.keys = {}
 
@@ -67,7 +72,9 @@ class Frame:
             self.keys[name] = key
         return key
 
-class BoneData:
+class BoneData(object):
+    __slots__ = ("repeat", "reversed", "easing")
+
     def __init__(self):
         self.repeat = False
         self.reversed = False
@@ -333,26 +340,20 @@ class SkinnedAnimation:
                 copyKeyData(key, bones[name])
 
 
-class JsonEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, (KeyFrame, Frame, BoneData, SkinnedAnimation)):
-            d = obj.__dict__.copy()
-            for ignore in getattr(obj, "jsonIgnore", []):
-                if ignore in d:
-                    del d[ignore]
-            return d
-        elif isinstance(obj, euclid.Vector3):
-            return (obj.x, obj.y, obj.z)
-        elif isinstance(obj, ctypes.Array):
-            return list(obj)
-        return json.JSONEncoder.default(self, obj)
+def convertJson(obj):
+    if isinstance(obj, (KeyFrame, Frame, BoneData, SkinnedAnimation)):
+        return jsonwriter.getFields(obj, getattr(obj, "jsonIgnore", []))
+    elif isinstance(obj, euclid.Vector3):
+        return (obj.x, obj.y, obj.z)
+    raise TypeError("Can't write %r as JSON" % obj)
 
 DEPRECATED = []
 
 def checkJson(obj, data):
     ignores = getattr(obj, "jsonIgnore", []) + DEPRECATED
+    fields = jsonwriter.getFieldNames(obj)
     for key in data:
-        if not key in obj.__dict__ and key not in ignores:
+        if not key in fields and key not in ignores:
             name = obj.__class__.__name__
             raise RuntimeError("Key '%s' in JSON but not in object '%s'" % (key, name))
 
@@ -363,8 +364,7 @@ def saveAnimationToFile(path, animation):
         "version": VERSION,
         "animation": animation,
     }
-    with open(path, "w") as f:
-        json.dump(data, f, indent=1, cls=JsonEncoder, separators=(",", ": "), sort_keys=True)
+    jsonwriter.save(data, path, convertJson)
 
 def loadAnimationFromFile(path):
     data = None
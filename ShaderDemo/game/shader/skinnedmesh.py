@@ -1,12 +1,21 @@
 
+import ctypes
 from OpenGL import GL as gl
 
 import geometry
 import utils
 
 def makeArray(tp, values):
+    if isinstance(values, ctypes.Array) and values._type_ is tp:
+        #Used as is, for example when it points to a memory mapped file
+        return values
     return (tp * len(values))(*values)
 
+def getArrayBytes(values):
+    if values is None:
+        return 0
+    return ctypes.sizeof(values)
+
 def roundPoint(x, y):
     return (int(round(x)), int(round(y)))
 
@@ -25,6 +34,12 @@ class SkinnedMesh:
         self.boneWeights = None
         self.boneIndices = None
 
+    def isLoaded(self):
+        return True
+
+    def getResidentBytes(self):
+        return sum([getArrayBytes(a) for a in (self.vertices, self.indices, self.uvs, self.boneWeights, self.boneIndices)])
+
     def getTriangleIndices(self):
         triangles = []
         if self.indices:
@@ -271,6 +286,42 @@ class SkinnedMesh:
         self.boneWeights = makeArray(gl.GLfloat, weights)
         self.boneIndices = makeArray(gl.GLfloat, indices)
 
+LAZY_ATTRIBUTES = ("vertices", "indices", "uvs", "boneWeights", "boneIndices")
+
+class LazyMesh(SkinnedMesh):
+    #Stands in for a mesh of a lazily loaded rig. The arrays are decoded by the
+    #loader the first time any of them is used, after that this is a normal mesh.
+    jsonIgnore = SkinnedMesh.jsonIgnore + ["loader", "bone"]
+
+    def __init__(self, loader, bone):
+        self.loader = loader
+        self.bone = bone #For the uvs of rigs that don't have them baked
+
+    def __getattr__(self, name):
+        #Only called for attributes that don't exist yet
+        if name in LAZY_ATTRIBUTES and self.__dict__.get("loader"):
+            self.load()
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def isLoaded(self):
+        return self.loader is None
+
+    def load(self):
+        if self.loader:
+            vertices, indices, boneWeights, boneIndices, uvs = self.loader()
+            SkinnedMesh.__init__(self, vertices, indices, boneWeights, boneIndices)
+            self.uvs = uvs
+            if not self.uvs:
+                self.updateUvs(self.bone)
+            self.loader = None
+            self.bone = None
+
+    def getResidentBytes(self):
+        if self.loader:
+            return 0
+        return SkinnedMesh.getResidentBytes(self)
+
 def findBoneImageBone(bone, bones):
     for parent in [bone] + bone.getParents(bones):
         if parent.image:
@@ -303,7 +354,9 @@ def findBlockerNames(meshBone, bones):
 
     return results
 
-class BoneWeight:
+class BoneWeight(object):
+    __slots__ = ("distance", "index", "transform", "bone", "weight")
+
     def __init__(self, distance, index, transform):
         self.distance = distance
         self.index = index
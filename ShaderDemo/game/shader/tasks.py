@@ -0,0 +1,182 @@
+
+import threading
+import collections
+import multiprocessing
+import Queue
+
+import shader
+
+class PartialResultError(Exception):
+    #Raised by a task that failed after creating something that still has to be
+    #freed, PreparedStore frees it on the main thread
+
+    def __init__(self, error, partial):
+        Exception.__init__(self, str(error))
+        self.error = error
+        self.partial = partial
+
+
+class Task:
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+        self.finished = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception as e:
+            self.error = e
+        self.finished.set()
+
+    def isDone(self):
+        return self.finished.is_set()
+
+    def wait(self):
+        #Blocks until the task has run, then returns its result or raises its error
+        self.finished.wait()
+        if self.error:
+            raise self.error
+        return self.result
+
+
+class Worker:
+    #A single background thread that runs tasks in submission order
+
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, func, *args):
+        task = Task(func, args)
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.loop, name="ShaderWorker")
+                self.thread.daemon = True
+                self.thread.start()
+        self.queue.put(task)
+        return task
+
+    def loop(self):
+        while True:
+            self.queue.get().run()
+
+
+class ThreadPool:
+    #Runs a function for many items on several background threads. Results are
+    #returned as they finish, so the caller can use them while the rest still run.
+
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def getThreadCount(self):
+        if shader.config.loadThreads:
+            return shader.config.loadThreads
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return 2
+
+    def start(self):
+        with self.lock:
+            if not self.threads:
+                for i in range(self.getThreadCount()):
+                    thread = threading.Thread(target=self.loop, name="ShaderLoader%i" % i)
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+
+    def loop(self):
+        while True:
+            func, item, results = self.queue.get()
+            try:
+                results.put((item, func(item), None))
+            except Exception as e:
+                results.put((item, None, e))
+
+    def imapUnordered(self, func, items):
+        #Yields (item, result) pairs in the order they finish
+        items = list(items)
+        if len(items) < 2 or self.getThreadCount() < 2:
+            for item in items:
+                yield item, func(item)
+            return
+
+        self.start()
+        results = Queue.Queue()
+        for item in items:
+            self.queue.put((func, item, results))
+
+        for i in range(len(items)):
+            item, result, error = results.get()
+            if error:
+                raise error
+            yield item, result
+
+
+class PreparedStore:
+    #Renderers prepared in the background during image prediction, waiting
+    #for their displayable to be shown. Oldest are dropped when full, dropped
+    #renderers are freed so their rig templates and decoded images are released.
+
+    def __init__(self, size=8):
+        self.size = size
+        self.tasks = collections.OrderedDict()
+        self.discarded = [] #Dropped tasks that were still running
+
+    def has(self, tag):
+        return tag in self.tasks
+
+    def add(self, tag, task):
+        self.freeDiscarded()
+        self.discard(self.tasks.pop(tag, None))
+        self.tasks[tag] = task
+        while len(self.tasks) > self.size:
+            tag, old = self.tasks.popitem(last=False)
+            self.discard(old)
+
+    def pop(self, tag):
+        #Returns the prepared object, None if there is none or the preparation failed
+        self.freeDiscarded()
+        task = self.tasks.pop(tag, None)
+        if not task:
+            return None
+        try:
+            return task.wait()
+        except Exception as e:
+            shader.log("Background preparation failed: %s" % e)
+            self.discard(task)
+            return None
+
+    def discard(self, task):
+        if task:
+            self.discarded.append(task)
+            self.freeDiscarded()
+
+    def freeDiscarded(self):
+        #Frees the results of dropped tasks that have finished. Called from the
+        #main thread, because freeing can touch OpenGL.
+        running = []
+        for task in self.discarded:
+            if not task.isDone():
+                running.append(task)
+                continue
+            result = task.result
+            if isinstance(task.error, PartialResultError):
+                result = task.error.partial
+            if result is not None:
+                result.free()
+        self.discarded = running
+
+    def clear(self):
+        for task in self.tasks.values():
+            self.discard(task)
+        self.tasks.clear()
+
+worker = Worker()
+pool = ThreadPool()
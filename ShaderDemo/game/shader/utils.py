@@ -7,6 +7,8 @@ import ctypes
 import euclid
 from OpenGL import GL as gl
 
+import glstate
+
 FONT_SIZE = 18
 FONT = None
 
@@ -131,16 +133,15 @@ def glTextureFromSurface(surface):
 
     gl.glGenTextures(1, textureId)
     gl.glEnable(gl.GL_TEXTURE_2D)
-    gl.glActiveTexture(gl.GL_TEXTURE0)
 
     gl.glPixelStorei(gl.GL_UNPACK_ROW_LENGTH, surface.get_pitch() // surface.get_bytesize())
-    gl.glBindTexture(gl.GL_TEXTURE_2D, textureId[0])
+    glstate.tracker.bindTexture(0, textureId[0])
     gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE)
     gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T, gl.GL_CLAMP_TO_EDGE)
     gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
     gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
     gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA, width, height, 0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, ptr)
-    gl.glBindTexture(gl.GL_TEXTURE_2D, 0);
+    glstate.tracker.bindTexture(0, 0)
     gl.glPixelStorei(gl.GL_UNPACK_ROW_LENGTH, 0)
 
     surface.unlock()
@@ -185,13 +186,37 @@ def findFile(name):
 def openFile(path):
     return renpy.exports.file(path)
 
+def fileExists(path):
+    return renpy.exports.loadable(path)
+
+def getRealPath(path):
+    #Path in the file system, None if the file is inside an archive
+    try:
+        return renpy.loader.transfn(path)
+    except Exception:
+        return None
+
+def getFileTime(path):
+    realPath = getRealPath(path)
+    if realPath:
+        return os.path.getmtime(realPath)
+    return None
+
 class Shader:
     def __init__(self, vsCode, psCode):
-        self.handle = gl.glCreateProgram()
+        #Sources are kept so the program can be rebuilt after a context loss
+        self.vsCode = vsCode
+        self.psCode = psCode
+        self.handle = 0
         self.linked = False
+        self.locations = {}
+        self.create()
+
+    def create(self):
+        self.handle = gl.glCreateProgram()
 
-        self.createShader(vsCode, gl.GL_VERTEX_SHADER)
-        self.createShader(psCode, gl.GL_FRAGMENT_SHADER)
+        self.createShader(self.vsCode, gl.GL_VERTEX_SHADER)
+        self.createShader(self.psCode, gl.GL_FRAGMENT_SHADER)
 
         self.link()
 
@@ -220,35 +245,67 @@ class Shader:
 
     def free(self):
         if self.handle:
+            glstate.tracker.forgetProgram(self.handle)
             gl.glDeleteProgram(self.handle)
             self.handle = 0
         self.linked = False
 
+    def invalidate(self):
+        #The context that owned the program is gone, forget the handle without deleting it
+        glstate.tracker.forgetProgram(self.handle)
+        self.handle = 0
+        self.linked = False
+        self.locations.clear()
+
+    def restore(self):
+        self.create()
+
     def bind(self):
-        gl.glUseProgram(self.handle)
+        glstate.tracker.useProgram(self.handle)
 
     def unbind(self):
-        gl.glUseProgram(0)
+        glstate.tracker.useProgram(0)
+
+    def getUniformLocation(self, name):
+        loc = self.locations.get(name)
+        if loc is None:
+            loc = gl.glGetUniformLocation(self.handle, name)
+            self.locations[name] = loc
+        return loc
+
+    def hasUniform(self, name):
+        #The compiler removes uniforms that can't affect the output
+        return self.getUniformLocation(name) != -1
 
     def uniformf(self, name, *values):
         {1 : gl.glUniform1f,
          2 : gl.glUniform2f,
          3 : gl.glUniform3f,
          4 : gl.glUniform4f
-        }[len(values)](gl.glGetUniformLocation(self.handle, name), *values)
+        }[len(values)](self.getUniformLocation(name), *values)
 
     def uniformi(self, name, *values):
         {1 : gl.glUniform1i,
          2 : gl.glUniform2i,
          3 : gl.glUniform3i,
          4 : gl.glUniform4i
-        }[len(values)](gl.glGetUniformLocation(self.handle, name), *values)
+        }[len(values)](self.getUniformLocation(name), *values)
 
     def uniformMatrix4f(self, name, matrix):
-        loc = gl.glGetUniformLocation(self.handle, name)
+        loc = self.getUniformLocation(name)
         gl.glUniformMatrix4fv(loc, 1, False, (ctypes.c_float * 16)(*matrix))
 
     def uniformMatrix4fArray(self, name, values):
-        loc = gl.glGetUniformLocation(self.handle, name)
+        loc = self.getUniformLocation(name)
         count = len(values) / 16
         gl.glUniformMatrix4fv(loc, count, False, (ctypes.c_float * len(values))(*values))
+
+    def uniform4fv(self, name, array, count):
+        #Uploads count vec4s directly from a preallocated ctypes float array
+        loc = self.getUniformLocation(name)
+        gl.glUniform4fv(loc, count, array)
+
+    def uniformMatrix4fv(self, name, array, count):
+        #Uploads directly from a preallocated ctypes float array
+        loc = self.getUniformLocation(name)
+        gl.glUniformMatrix4fv(loc, count, False, array)
@@ -0,0 +1,181 @@
+
+"""
+    Compiles rigs into runtime bundles so that the game does no image or geometry
+    processing when a rig is loaded.
+
+    Requires Pillow Python image processing library to be installed.
+
+    Command line examples (current working directory at the base of this project):
+
+        python tools/compile_rig.py ShaderDemo/game/rig/doll.rig
+        python tools/compile_rig.py ShaderDemo/game/rig
+
+    A directory compiles every .rig in it in parallel. The game directory used to
+    find the rig images is the parent of the rig directory, unless given as the
+    second argument.
+
+    For every rig this writes:
+
+        <name>.rigb                  Binary rig with the sorted meshes, weights and uvs
+        <name> atlas.png             Cropped bone images packed into one image
+        <name> influence atlas.png   Influence images in the same layout, if there are any
+
+    The game uses the .rigb automatically when it is not older than the .rig.
+"""
+
+import sys
+import os
+import multiprocessing
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ShaderDemo", "game", "shader"))
+import rigformat
+
+IMAGES = [".png", ".jpg"]
+PAD = 2
+INFLUENCE = " influence"
+
+def findImage(gameDir, name):
+    #Rig image names are either file names relative to the game directory or Ren'Py image names
+    path = os.path.join(gameDir, name)
+    if os.path.isfile(path):
+        return path
+
+    for ext in IMAGES:
+        if os.path.isfile(path + ext):
+            return path + ext
+
+    for root, dirs, files in os.walk(gameDir):
+        for f in files:
+            base, ext = os.path.splitext(f)
+            if ext.lower() in IMAGES and base == name:
+                return os.path.join(root, f)
+    return None
+
+def getInfluenceName(name):
+    #Same as SkinnedRenderer.getInfluenceName()
+    return name.split(".")[0] + INFLUENCE
+
+def cropImage(path, image, resize=False):
+    source = Image.open(path).convert("RGBA")
+    scale = 1
+    if resize:
+        scale = source.size[0] / float(image["originalWidth"])
+    crop = [int(round(x * scale)) for x in (image["x"], image["y"], image["width"], image["height"])]
+    cropped = source.crop((crop[0], crop[1], crop[0] + crop[2], crop[1] + crop[3]))
+    if cropped.size != (image["width"], image["height"]):
+        #Influence images share the layout and uvs of the bone images
+        cropped = cropped.resize((image["width"], image["height"]), Image.BILINEAR)
+    return cropped
+
+def packRects(sizes):
+    #Simple shelf packing, tallest first. Returns rects by key and the atlas size.
+    area = sum([(w + PAD) * (h + PAD) for w, h in sizes.values()])
+    maxWidth = max([int(area ** 0.5 * 1.25)] + [w + PAD for w, h in sizes.values()])
+
+    rects = {}
+    x = y = shelfHeight = width = 0
+    for key in sorted(sizes, key=lambda k: (-sizes[k][1], k)):
+        w, h = sizes[key]
+        if x + w > maxWidth:
+            x = 0
+            y += shelfHeight + PAD
+            shelfHeight = 0
+        rects[key] = (x, y, w, h)
+        x += w + PAD
+        width = max(width, x)
+        shelfHeight = max(shelfHeight, h)
+
+    return rects, (max(width - PAD, 1), max(y + shelfHeight, 1))
+
+def computeUvs(bone):
+    #Same as SkinnedMesh.updateUvs()
+    vertices = bone["mesh"]["vertices"]
+    w = float(bone["image"]["width"])
+    h = float(bone["image"]["height"])
+    uvs = []
+    for i in range(0, len(vertices), 2):
+        uvs.append((vertices[i] - bone["pos"][0]) / w)
+        uvs.append((vertices[i + 1] - bone["pos"][1]) / h)
+    return uvs
+
+def getRelativePath(path, gameDir):
+    return os.path.relpath(path, gameDir).replace("\\", "/")
+
+def compileRig(args):
+    path, gameDir = args
+    data = rigformat.loadJson(path)
+    base = path.rsplit(".", 1)[0]
+
+    images = {}
+    influences = {}
+    for name, bone in data["bones"].items():
+        image = bone.get("image")
+        if not image:
+            continue
+
+        imagePath = findImage(gameDir, image["name"])
+        if not imagePath:
+            raise RuntimeError("Image '%s' of bone '%s' not found" % (image["name"], name))
+        images[name] = cropImage(imagePath, image)
+
+        influencePath = findImage(gameDir, getInfluenceName(image["name"]))
+        if influencePath:
+            influences[name] = cropImage(influencePath, image, True)
+
+        if bone.get("mesh"):
+            bone["mesh"]["uvs"] = computeUvs(bone)
+
+    if images:
+        rects, size = packRects(dict((name, image.size) for name, image in images.items()))
+        atlas = {"rects": rects, "influence": sorted(influences)}
+
+        atlasImage = Image.new("RGBA", size, (0, 0, 0, 0))
+        for name, image in images.items():
+            atlasImage.paste(image, rects[name][:2])
+        atlasPath = base + " atlas.png"
+        atlasImage.save(atlasPath)
+        atlas["image"] = getRelativePath(atlasPath, gameDir)
+
+        if influences:
+            influenceImage = Image.new("RGBA", size, (0, 0, 0, 255))
+            for name, image in influences.items():
+                influenceImage.paste(image, rects[name][:2])
+            influencePath = base + INFLUENCE + " atlas.png"
+            influenceImage.save(influencePath)
+            atlas["influenceImage"] = getRelativePath(influencePath, gameDir)
+
+        data["atlas"] = atlas
+
+    target = rigformat.getBinaryPath(path)
+    rigformat.save(data, target)
+    return "%s (%i images, %i influence images)" % (target, len(images), len(influences))
+
+def main():
+    source = sys.argv[1]
+    if os.path.isdir(source):
+        rigs = [os.path.join(source, name) for name in sorted(os.listdir(source)) if name.lower().endswith(".rig")]
+        rigDir = source
+    else:
+        rigs = [source]
+        rigDir = os.path.dirname(source)
+
+    if len(sys.argv) > 2:
+        gameDir = sys.argv[2]
+    else:
+        gameDir = os.path.dirname(os.path.abspath(rigDir))
+
+    jobs = [(rig, gameDir) for rig in rigs]
+    if len(jobs) > 1:
+        pool = multiprocessing.Pool()
+        results = pool.map(compileRig, jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = [compileRig(job) for job in jobs]
+
+    for result in results:
+        print("Wrote: %s" % result)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+
+"""
+    Converts rig files between the JSON (.rig) and the binary (.rigb) format.
+
+    The game loads the binary version of a rig automatically if it exists and is
+    not older than the JSON version. The JSON file is still the one edited and
+    saved by the rig editor, so convert again after editing.
+
+    Command line examples (current working directory at the base of this project):
+
+        python tools/convert_rig.py ShaderDemo/game/rig/doll.rig
+        python tools/convert_rig.py ShaderDemo/game/rig/doll.rigb
+        python tools/convert_rig.py ShaderDemo/game/rig
+
+    A .rig is written as a .rigb and the other way around. A directory converts
+    every .rig in it into a .rigb.
+"""
+
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ShaderDemo", "game", "shader"))
+import rigformat
+
+def toBinary(path):
+    target = rigformat.getBinaryPath(path)
+    rigformat.save(rigformat.loadJson(path), target)
+    print("Wrote: %s" % target)
+
+def toJson(path):
+    target = path.rsplit(".", 1)[0] + ".rig"
+    rigformat.saveJson(rigformat.load(path), target)
+    print("Wrote: %s" % target)
+
+def convert(path):
+    if path.lower().endswith(rigformat.EXTENSION):
+        toJson(path)
+    else:
+        toBinary(path)
+
+source = sys.argv[1]
+if os.path.isdir(source):
+    for name in sorted(os.listdir(source)):
+        if name.lower().endswith(".rig"):
+            toBinary(os.path.join(source, name))
+else:
+    convert(source)